@@ -0,0 +1,116 @@
+'''
+Compiles participant plans into motor operations
+
+A plan arrives as [(opcode, value), ...], one entry per step the planner built,
+decoded from the wire by remote.decode_plan.  Participants
+often chain small steps like up 1, up 1, up 0.5 or left 1, right 0.5, and running
+each one on its own costs a ramp up and a full stop per step.  compile_plan()
+normalises the plan first so the robot drives each leg in one motion and ends up
+in the same place.
+'''
+
+# Plan step opcodes.  Must match marsbots-host/protocol.py
+FORWARD = 1
+REVERSE = 2
+LEFT = 3
+RIGHT = 4
+GRAB = 5
+RELEASE = 6
+
+# Compiled operations
+OP_DRIVE = 'drive'
+OP_TURN = 'turn'
+OP_GRAB = 'grab'
+OP_RELEASE = 'release'
+
+driveSpeed = 35
+turnSpeed = 35
+turnRotations = 0.4925 # wheel rotations per unit of turn
+
+_motions = (OP_DRIVE, OP_TURN)
+_epsilon = 1e-6 # rotations too small to bother the motors with
+
+
+def _normalise(step):
+    '''Returns (op, signed amount) for one plan step, or None if it is not understood'''
+    cmd, value = step
+    if cmd == FORWARD:
+        return OP_DRIVE, value
+    if cmd == REVERSE:
+        return OP_DRIVE, -value
+    if cmd == LEFT:
+        return OP_TURN, -value
+    if cmd == RIGHT:
+        return OP_TURN, value
+    if cmd == GRAB:
+        return OP_GRAB, 0.0
+    if cmd == RELEASE:
+        return OP_RELEASE, 0.0
+    return None
+
+
+def merge_steps(sequence):
+    '''Merges adjacent motions on the same axis and drops those that cancel out
+
+    Returns [(op, signed amount), ...].  A leg that cancels to nothing is removed,
+    which can bring its neighbours together, so up 1, left 1, right 1, up 1 is one
+    drive of 2.  Repeated grabs or releases collapse into one, as the second does
+    nothing.
+    '''
+    ops = []
+    for step in sequence:
+        op = _normalise(step)
+        if op is None:
+            continue
+        if ops and ops[-1][0] == op[0]:
+            if op[0] in _motions:
+                amount = ops[-1][1] + op[1]
+                ops.pop()
+                if abs(amount) > _epsilon:
+                    ops.append((op[0], amount))
+            continue
+        if op[0] in _motions and abs(op[1]) <= _epsilon:
+            continue
+        ops.append(op)
+    return ops
+
+
+def _overlaps(op, following):
+    '''Whether the operation after op may start before op finishes
+
+    The grabber runs alongside the drive only where that cannot disturb a sample:
+    * a grab always finishes before anything else starts, so the sample is held
+      before the robot moves off with it
+    * a release may overlap a following reverse, so the robot backs away from
+      the sample while the grabber opens; the reverse is only over once the
+      grabber has opened too
+    * a release before anything else finishes first, so the robot does not drive
+      into or turn across a sample it is still letting go of
+    * a motion always finishes before the next step starts
+    '''
+    if op[0] != OP_RELEASE or following is None:
+        return False
+    return following[0] == OP_DRIVE and following[1] < 0
+
+
+def compile_plan(sequence):
+    '''Compiles a plan into motor operations, ready to issue without further work
+
+    Returns [(op, steering, speed, rotations, overlap), ...], where steering, speed
+    and rotations are the MoveSteering.on_for_rotations arguments for motions and
+    unused for the grabber, and overlap says whether the next operation may start
+    while this one is still running.
+    '''
+    if not isinstance(sequence, list):
+        return []
+    ops = merge_steps(sequence)
+    compiled = []
+    for i, (op, amount) in enumerate(ops):
+        overlap = _overlaps(ops[i], ops[i + 1] if i + 1 < len(ops) else None)
+        if op == OP_DRIVE:
+            compiled.append((op, 0, driveSpeed, amount, overlap))
+        elif op == OP_TURN:
+            compiled.append((op, 100, turnSpeed, turnRotations * amount, overlap))
+        else:
+            compiled.append((op, 0, 0, 0.0, overlap))
+    return compiled
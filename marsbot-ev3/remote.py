@@ -1,6 +1,9 @@
 import subprocess
+import threading
+import time
 import bluetooth
 import socket
+import struct
 from Screen import debug_print
 
 
@@ -12,6 +15,37 @@ _tcp_port = 32390
 _ad_port = 32391
 _bt_port = 3
 
+# Wire protocol shared with the host.  Must match marsbots-host/protocol.py
+# Every message is a frame: 1 byte message type, 4 byte big-endian payload length, payload.
+PROTOCOL_VERSION = 4
+
+MSG_HELLO = 1
+MSG_PING = 2
+MSG_CLOSE = 4
+MSG_PLAN = 5
+MSG_TELEMETRY = 6
+MSG_PONG = 7 # echoes the PING payload
+
+_header = struct.Struct('!BI')
+_version = struct.Struct('!H')
+_max_payload = 64 * 1024
+
+# A PLAN payload is a 4 byte plan id and a 2 byte step count, followed by one 5 byte step
+# per plan step: an opcode byte (see plan_compiler) and a big-endian float argument.
+_plan_header = struct.Struct('!IH')
+_plan_step = struct.Struct('!Bf')
+
+# A TELEMETRY payload is a fixed record, followed by a UTF-8 message for errors:
+#   kind, plan id, step, robot clock seconds, left and right wheel encoder degrees, battery volts
+TM_ACCEPTED = 1 # step holds the number of compiled steps
+TM_STEP_START = 2
+TM_STEP_END = 3
+TM_DONE = 4
+TM_STATUS = 5
+TM_ERROR = 6
+
+_telemetry = struct.Struct('!BIHdiif')
+
 
 # Check to see if the robot is connected to an IP network
 _hostname = socket.gethostname()
@@ -67,3 +101,104 @@ def get_listener_socket():
 def advertise():
     if _use_tcp:
         _ad_server.sendto(_b_hostname, ("<broadcast>", _ad_port))
+
+
+def encode_frame(msg_type, payload=b''):
+    return _header.pack(msg_type, len(payload)) + payload
+
+
+class FrameDecoder:
+    '''Reassembles whole (type, payload) messages from a byte stream.
+
+    Partial frames are buffered until the rest of the frame arrives.
+    '''
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        messages = []
+        start = 0
+        while len(self._buffer) - start >= _header.size:
+            msg_type, length = _header.unpack_from(self._buffer, start)
+            if length > _max_payload:
+                raise ValueError('Frame of {} bytes exceeds the protocol limit'.format(length))
+            end = start + _header.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append((msg_type, bytes(self._buffer[start + _header.size:end])))
+            start = end
+        del self._buffer[:start]
+        return messages
+
+
+def decode_plan(payload):
+    '''Unpacks a PLAN payload into (plan id, [(opcode, value), ...])'''
+    if len(payload) < _plan_header.size:
+        raise ValueError('Plan payload is too short')
+    plan_id, count = _plan_header.unpack_from(payload)
+    if len(payload) != _plan_header.size + count * _plan_step.size:
+        raise ValueError('Plan payload length does not match its step count')
+    return plan_id, list(_plan_step.iter_unpack(payload[_plan_header.size:]))
+
+
+class TelemetryLink:
+    '''Sends telemetry to the host over one connection.
+
+    Safe to use from several threads.  Send errors are ignored: the thread reading
+    from the host notices the connection has gone and closes the link.
+    '''
+
+    def __init__(self, client):
+        self.closed = threading.Event()
+        self._client = client
+        self._lock = threading.Lock()
+
+    def send(self, kind, plan_id=0, step=0, left=0, right=0, battery=0.0, message=''):
+        payload = _telemetry.pack(kind, plan_id, step, time.time(), left, right, battery)
+        payload += message.encode('utf-8')
+        self.send_frame(MSG_TELEMETRY, payload)
+
+    def pong(self, payload):
+        self.send_frame(MSG_PONG, payload)
+
+    def send_frame(self, msg_type, payload):
+        with self._lock:
+            if self.closed.is_set():
+                return
+            try:
+                self._client.sendall(encode_frame(msg_type, payload))
+            except OSError:
+                pass
+
+    def close(self):
+        self.closed.set()
+
+
+def receive_messages(client):
+    '''Yields whole messages from the host until the connection closes'''
+    decoder = FrameDecoder()
+    while True:
+        data = client.recv(size)
+        if not data:
+            return
+        for message in decoder.feed(data):
+            yield message
+
+
+def accept_handshake(client, messages):
+    '''Answers the host's HELLO with our protocol version.
+
+    Returns True if the host speaks the same version.
+    '''
+    message = next(messages, None)
+    if message is None or message[0] != MSG_HELLO:
+        debug_print('Host did not start with HELLO')
+        return False
+    version = _version.unpack(message[1])[0]
+    client.sendall(encode_frame(MSG_HELLO, _version.pack(PROTOCOL_VERSION)))
+    if version != PROTOCOL_VERSION:
+        debug_print('Host protocol version', version, 'does not match', PROTOCOL_VERSION)
+        return False
+    return True
@@ -4,28 +4,23 @@ SSCI MarsBot robot server
 """
 
 import remote
-import pickle
-import json
+import plan_compiler
+import queue
+import threading
 import time
 
 from ev3dev2 import DeviceNotFound
 from ev3dev2.motor import MediumMotor, MoveSteering, SpeedPercent, OUTPUT_A, OUTPUT_B, OUTPUT_C
 from ev3dev2.led import Led, Leds
+from ev3dev2.power import PowerSupply
 from ev3dev2.display import Display
 from Screen import init_console, reset_console, debug_print
 
 
-FORWARD = u'\u2191' # up-arrow glyph
-REVERSE = u'\u2193' # down-arrow glyph
-LEFT = u'\u2190' # left-arrow glyph
-RIGHT = u'\u2192' # right-arrow glyph
-GRAB = 'Grab'
-RELEASE = 'Release'
-
-driveSpeed = 35
-turnSpeed = 35
 grabSpeed = 40
 holdSpeed = 10
+statusInterval = 0.25 # seconds between status reports to the host
+hostTimeout = 2 # the host pings twice a second; this long without a word means it has gone
 
 init_console()
 
@@ -44,15 +39,11 @@ while True:
         time.sleep(1)
 
 debug_print('stop actions:', grabMotor.stop_actions)
-debug_print('pickle.HIGHEST_PROTOCOL:', pickle.HIGHEST_PROTOCOL)
-
 
-def move(value):
-    steeringDrive.on_for_rotations(0, driveSpeed, 1.0 * value)
 
-
-def turn(value):
-    steeringDrive.on_for_rotations(100, turnSpeed, 0.4925 * value)
+def motion(steering, speed, rotations):
+    # blocks until the motors have started and then stopped again
+    steeringDrive.on_for_rotations(steering, speed, rotations, block=True)
 
 
 def grab():
@@ -76,6 +67,85 @@ def release():
     debug_print('released')
 
 
+# The grabber runs on its own thread so it can move while the robot drives.
+# Only one grabber motion runs at a time.
+grabber = None
+
+
+def start_grabber(action):
+    global grabber
+    wait_grabber()
+    grabber = threading.Thread(target=action)
+    grabber.start()
+
+
+def wait_grabber():
+    if grabber is not None:
+        grabber.join()
+
+
+def positions():
+    return steeringDrive.left_motor.position, steeringDrive.right_motor.position
+
+
+def stalled():
+    return 'stalled' in steeringDrive.left_motor.state or 'stalled' in steeringDrive.right_motor.state
+
+
+def run_plan(link, plan_id, ops):
+    # ops come from plan_compiler.compile_plan, so each motor command is issued the
+    # moment the previous one finishes, with no parsing in between.  A step marked
+    # overlap lets the next one start while it is still running; see
+    # plan_compiler._overlaps.  Progress is reported to the host as it goes.
+    for step, (op, steering, speed, rotations, overlap) in enumerate(ops):
+        #debug_print(op, rotations, overlap)
+        link.send(remote.TM_STEP_START, plan_id, step, *positions())
+        if op in (plan_compiler.OP_DRIVE, plan_compiler.OP_TURN):
+            motion(steering, speed, rotations)
+            if stalled():
+                # something is in the way; stop rather than grind through the rest of the plan
+                steeringDrive.off()
+                wait_grabber()
+                link.send(remote.TM_ERROR, plan_id, step, *positions(), message='Drive stalled')
+                return
+            # a release overlapping this motion must finish before the step after it starts
+            wait_grabber()
+        elif op in (plan_compiler.OP_GRAB, plan_compiler.OP_RELEASE):
+            start_grabber(grab if op == plan_compiler.OP_GRAB else release)
+            if not overlap:
+                wait_grabber()
+        link.send(remote.TM_STEP_END, plan_id, step, *positions())
+    # the plan is done when everything has stopped
+    wait_grabber()
+    link.send(remote.TM_DONE, plan_id, len(ops), *positions())
+
+
+# Plans run one after another on the executor thread, so the connection keeps
+# being read (and pinged) while the robot drives
+plans = queue.Queue()
+currentPlan = 0
+
+
+def execute_plans():
+    global currentPlan
+    while True:
+        link, plan_id, ops = plans.get()
+        currentPlan = plan_id
+        try:
+            run_plan(link, plan_id, ops)
+        except Exception as error:
+            debug_print('Plan failed:', error)
+            link.send(remote.TM_ERROR, plan_id, message=str(error))
+        currentPlan = 0
+
+
+def report_status(link):
+    # Lets the host know we are alive several times a second, even when idle
+    while not link.closed.wait(statusInterval):
+        left, right = positions()
+        link.send(remote.TM_STATUS, currentPlan, 0, left, right, power.measured_volts)
+
+
 leds = Leds()
 #debug_print(Led().triggers)
 leds.set('LEFT', trigger='default-on')
@@ -85,8 +155,12 @@ display = Display()
 screenw = display.xres
 screenh = display.yres
 
-# reset the grab motor to a known good position
-release()
+power = PowerSupply()
+threading.Thread(target=execute_plans, daemon=True).start()
+
+# reset the grab motor to a known good position while the robot waits for the host;
+# the first grabber step of the first plan waits for it to finish
+start_grabber(release)
 
 # Create connection to server
 s, host_address = remote.get_listener_socket()
@@ -94,6 +168,7 @@ s.settimeout(5)
 
 # Main loop handles connections to the host
 while True:
+    link = None
     try:
         reset_console()
         print (host_address)
@@ -107,50 +182,38 @@ while True:
         except:
             continue
 
-        client.settimeout(10)
+        client.settimeout(hostTimeout)
         print ('Connected')
         debug_print('Connected to:', clientInfo)
         leds.set_color('LEFT', 'GREEN')
         leds.set_color('RIGHT', 'GREEN')
 
+        messages = remote.receive_messages(client)
+        if not remote.accept_handshake(client, messages):
+            client.close()
+            continue
+
+        link = remote.TelemetryLink(client)
+        threading.Thread(target=report_status, args=(link,), daemon=True).start()
+
         # Driving loop
-        while True:
-            data = client.recv(remote.size)
-            #debug_print('recv:', data)
-            if data == b'':
-                client.close()
+        for msg_type, payload in messages:
+            if msg_type == remote.MSG_CLOSE:
                 break
-
-            if data:
-                #debug_print(data)
-                jd = pickle.loads(data)
-                #debug_print(jd)
-                if jd == 'ping':
-                    continue
-
-                sequence = json.loads(jd)
-
-                # command format: [[cmd, value], ...]
-                #debug_print(sequence)
-                if isinstance(sequence, list):
-                    for step in sequence:
-                        #debug_print(step)
-                        cmd = step[0]
-                        #debug_print(cmd)
-                        value = float(step[1]) if len(step) > 1 else 0.0
-                        #debug_print(value)
-                        if cmd == FORWARD:
-                            move(value)
-                        elif cmd == REVERSE:
-                            move(-value)
-                        elif cmd == LEFT:
-                            turn(-value)
-                        elif cmd == RIGHT:
-                            turn(value)
-                        elif cmd == GRAB:
-                            grab()
-                        elif cmd == RELEASE:
-                            release()
+            if msg_type == remote.MSG_PING:
+                link.pong(payload)
+                continue
+            if msg_type != remote.MSG_PLAN:
+                continue
+
+            plan_id, sequence = remote.decode_plan(payload)
+            ops = plan_compiler.compile_plan(sequence)
+            link.send(remote.TM_ACCEPTED, plan_id, len(ops))
+            plans.put((link, plan_id, ops))
+        link.close()
+        client.close()
     except:
+        if link:
+            link.close()
         client.close()
 s.close()
@@ -1,15 +1,44 @@
+import argparse
+import time
 import core
 import ad_monitor
+import admin_host
 import api_host
-import control_gui
+import engine
+import metrics
+
+parser = argparse.ArgumentParser(description='Shared Science Marsbot host')
+parser.add_argument('--headless', action='store_true',
+                    help='run without the operator console; control the game through the admin API')
+parser.add_argument('--no-klaxon', action='store_true', help='do not sound the rescue klaxon')
+parser.add_argument('--no-ads', action='store_true',
+                    help='do not listen for robot advertisements; arena_host passes them on instead')
+parser.add_argument('--profile', action='store_true',
+                    help='run the sampling profiler from startup; read it from /admin/profile')
+args = parser.parse_args()
+
+if args.profile:
+    metrics.start_profiler()
 
 core.startup()
 
 # Start server threads
 api_host.start()
-ad_monitor.start()
+admin_host.start()
+if not args.no_ads:
+    ad_monitor.start(core.found_robot)
+engine.start(alerts=not args.no_klaxon)
 
-control_gui.run_game()
+if args.headless:
+    print('Running headless, press Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+else:
+    import control_gui
+    control_gui.run_game()
 
 core.shutdown()
 
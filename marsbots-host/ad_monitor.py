@@ -1,24 +1,26 @@
 import socket
 import threading
-import core
 
 _ad_port = 32391
 _ad_socket = None
 _ad_mon_thread = None
+_on_found = None  # called with (name, ip, port) for every advertisement
 
 
 def _run_monitor():
     while True:
         data, addr_port = _ad_socket.recvfrom(1024)
         # print("received message: {} from {}".format(data, addr_port))
-        name = data.decode('utf-8')
+        # Robots send their hostname; simulated robots append ':port'
+        name, _, port = data.decode('utf-8').partition(':')
         addr = addr_port[0]
         print(f'Found robot {name} at {addr}')
-        core.found_robot(name, addr)
+        _on_found(name, addr, int(port) if port else None)
 
 
-def start():
-    global _ad_socket, _ad_mon_thread
+def start(on_found):
+    global _ad_socket, _ad_mon_thread, _on_found
+    _on_found = on_found
 
     _ad_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)  # UDP
 
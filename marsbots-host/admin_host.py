@@ -0,0 +1,222 @@
+import flask
+import os
+from flask import request
+import core
+import http_server
+import metrics
+
+# Operator API, an alternative to the console for running a game.
+# It listens on localhost only unless MARSBOTS_ADMIN_HOST says otherwise; if
+# MARSBOTS_ADMIN_TOKEN is set every request must carry it in the X-Admin-Token header.
+_admin_host = os.environ.get('MARSBOTS_ADMIN_HOST', '127.0.0.1')
+_admin_port = int(os.environ.get('MARSBOTS_ADMIN_PORT', 5001))
+_admin_token = os.environ.get('MARSBOTS_ADMIN_TOKEN')
+_admin_server = None
+app = flask.Flask("MarsbotsAdmin")
+
+
+@app.before_request
+def check_token():
+    if _admin_token and request.headers.get('X-Admin-Token') != _admin_token:
+        return {'status': 'fail', 'message': 'Not authorized'}, 403
+
+
+def _robot_arg():
+    robot = request.values.get('robot', type=int)
+    if robot not in core.get_valid_robot_numbers():
+        return None
+    return robot
+
+
+@app.route('/admin/state', methods=['GET'])
+def get_state():
+    state = core.get_state()
+    robots = {num: {'label': core.get_robot_label(num),
+                    'connected': core.get_connected(num),
+                    'link': dict(zip(('state', 'rtt_ms', 'jitter_ms', 'silent'), core.get_link_health(num))),
+                    'client': state.robot_clients.get(num),
+                    'rescue': num in state.rescues,
+                    'telemetry': core.get_robot_telemetry(num)._asdict(),
+                    'dispatch': dict(zip(('held', 'busy', 'mean_wait', 'max_wait', 'dropped'),
+                                         core.get_dispatch_queue(num)))}
+              for num in core.get_valid_robot_numbers()}
+    return {'status': 'ok',
+            'game_running': state.game_running,
+            'game_id': state.game_id,
+            'sol': core.get_sol(),
+            'config': dict(zip(('minutes', 'sols', 'short_trip', 'long_trip'), core.get_game_config())),
+            'robots': robots,
+            'pending_robots': list(state.pending_robots),
+            'waiting_clients': sorted(state.known_clients - state.client_robots.keys()),
+            'auto_assign': state.auto_assign,
+            'waitlist': [{'clientId': client, 'waiting': waiting} for client, waiting in core.get_waitlist()],
+            'assignment_waits': dict(zip(('mean', 'max'), core.get_assignment_waits()))}
+
+
+@app.route('/admin/config', methods=['POST'])
+def set_config():
+    if core.is_game_running():
+        return {'status': 'fail', 'message': 'Game is running'}
+    minutes, sols, short_trip, long_trip = core.get_game_config()
+    try:
+        core.set_game_config(
+            int(request.values.get('minutes', minutes)),
+            int(request.values.get('sols', sols)),
+            int(request.values.get('short_trip', short_trip)),
+            int(request.values.get('long_trip', long_trip)))
+    except ValueError:
+        return {'status': 'fail', 'message': 'Config values must be whole numbers'}
+    return {'status': 'ok'}
+
+
+@app.route('/admin/start', methods=['POST'])
+def start_game():
+    if core.is_game_running():
+        return {'status': 'fail', 'message': 'Game is already running'}
+    core.start_game()
+    return {'status': 'ok', 'game_id': core.get_state().game_id}
+
+
+@app.route('/admin/abort', methods=['POST'])
+def abort_game():
+    core.abort_game()
+    return {'status': 'ok'}
+
+
+@app.route('/admin/assign', methods=['POST'])
+def assign_robot():
+    robot = _robot_arg()
+    clientId = request.values.get('clientId')
+    if robot is None or not clientId:
+        return {'status': 'fail', 'message': 'Need a valid robot and clientId'}
+    core.assign_robot(robot, clientId)
+    if core.get_player_name(robot) != clientId:
+        return {'status': 'fail', 'message': 'Robot or client is already assigned'}
+    return {'status': 'ok'}
+
+
+@app.route('/admin/release', methods=['POST'])
+def release_robot():
+    clientId = request.values.get('clientId')
+    if clientId:
+        core.release_robot_from_client(clientId)
+        return {'status': 'ok'}
+    robot = _robot_arg()
+    if robot is None:
+        return {'status': 'fail', 'message': 'Need a valid robot or clientId'}
+    if core.get_taken(robot):
+        core.release_robot(robot)
+    return {'status': 'ok'}
+
+
+@app.route('/admin/auto_assign', methods=['POST'])
+def set_auto_assign():
+    enabled = request.values.get('enabled', type=int)
+    if enabled is None:
+        return {'status': 'fail', 'message': 'Need enabled=1 or enabled=0'}
+    core.set_auto_assign(bool(enabled))
+    return {'status': 'ok'}
+
+
+# Robot advertisements passed on by arena_host, which listens for them on behalf of every arena
+@app.route('/admin/found_robot', methods=['POST'])
+def found_robot():
+    name = request.values.get('name')
+    ip = request.values.get('ip')
+    if not name or not ip:
+        return {'status': 'fail', 'message': 'Need a robot name and ip'}
+    if not core.found_robot(name, ip, request.values.get('port', type=int)):
+        return {'status': 'fail', 'message': 'Not a robot in this arena'}
+    return {'status': 'ok'}
+
+
+@app.route('/admin/fleet', methods=['GET'])
+def get_fleet():
+    return {'status': 'ok',
+            'robots': [dict(rid, ip=ip) for rid, ip in core.get_fleet()],
+            'pending': [{'name': name, 'ip': ip, 'waiting': waiting}
+                        for name, ip, waiting in core.get_pending_robots()]}
+
+
+# Looks a robot up by name, Bluetooth address or the address it last advertised from
+@app.route('/admin/fleet/find', methods=['GET'])
+def find_robot():
+    found = core.find_robot(request.values.get('name'), request.values.get('btmac'), request.values.get('ip'))
+    if found is None:
+        return {'status': 'fail', 'message': 'No such robot in the fleet'}
+    rid, ip = found
+    return {'status': 'ok', 'robot': dict(rid, ip=ip)}
+
+
+# Adds a robot that advertised itself, as robot number or the next free one
+@app.route('/admin/fleet/confirm', methods=['POST'])
+def confirm_robot():
+    name = request.values.get('name')
+    if not name:
+        return {'status': 'fail', 'message': 'Need a robot name'}
+    number, message = core.confirm_robot(name, request.values.get('robot', type=int),
+                                         request.values.get('btmac'))
+    if number is None:
+        return {'status': 'fail', 'message': message}
+    return {'status': 'ok', 'robot': number}
+
+
+@app.route('/admin/fleet/ignore', methods=['POST'])
+def ignore_robot():
+    if not core.ignore_robot(request.values.get('name')):
+        return {'status': 'fail', 'message': 'No such robot waiting'}
+    return {'status': 'ok'}
+
+
+@app.route('/admin/fleet/reload', methods=['POST'])
+def reload_fleet():
+    if not core.reload_fleet():
+        return {'status': 'fail', 'message': 'Fleet file could not be read, see the host log'}
+    return {'status': 'ok', 'robots': core.get_valid_robot_numbers()}
+
+
+@app.route('/admin/clear_rescue', methods=['POST'])
+def clear_rescue():
+    robot = _robot_arg()
+    if robot is None:
+        return {'status': 'fail', 'message': 'Need a valid robot'}
+    core.clear_rescue(robot)
+    return {'status': 'ok'}
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return flask.Response(metrics.render(), content_type=metrics.content_type)
+
+
+# Sampling profiler: enable=1 starts it, enable=0 stops it, reset=1 discards the samples so far
+@app.route('/admin/profiler', methods=['POST'])
+def set_profiler():
+    if request.values.get('reset', type=int):
+        metrics.reset_profile()
+    enable = request.values.get('enable', type=int)
+    if enable:
+        metrics.start_profiler()
+    elif enable is not None:
+        metrics.stop_profiler()
+    return {'status': 'ok', 'running': metrics.profiler_running(), 'samples': metrics.get_profile()[0]}
+
+
+# Samples as folded stacks, ready for flamegraph.pl or speedscope
+@app.route('/admin/profile', methods=['GET'])
+def get_profile():
+    return flask.Response(metrics.get_profile()[1], content_type='text/plain; charset=utf-8')
+
+
+def start():
+    global _admin_server
+    _admin_server = http_server.HttpServer(app, _admin_host, _admin_port, threads=4)
+    _admin_server.start()
+    core.on_shutdown(stop)
+
+
+def stop():
+    global _admin_server
+    if _admin_server is not None:
+        _admin_server.stop()
+        _admin_server = None
@@ -1,12 +1,41 @@
 import flask
+import json
+import os
+import time
 from flask import request
 import core
-import threading
+import http_server
+import metrics
 
+_api_host = os.environ.get('MARSBOTS_API_HOST', '0.0.0.0')
+_api_port = int(os.environ.get('MARSBOTS_API_PORT', 5000))
 _api_server = None
+
+# Longest a long-poll or an idle event stream waits before answering
+_max_wait = 25.0
+_push = http_server.PushLimit()
+_push_refused = metrics.counter('marsbots_push_refused_total', 'Long-polls and event streams refused for want of a slot')
 app = flask.Flask("MarsbotsServer")
 # app.config["DEBUG"] = True
 
+_request_seconds = metrics.histogram('marsbots_http_request_seconds', 'Time to answer a participant API request',
+                                     ['route'])
+_requests = metrics.counter('marsbots_http_requests_total', 'Participant API requests answered', ['route', 'status'])
+
+
+@app.before_request
+def start_timer():
+    flask.g.start = time.perf_counter()
+
+
+# Event streams are timed until their response starts, not for as long as they stay open
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    _request_seconds.observe(time.perf_counter() - flask.g.start, route)
+    _requests.inc(route, str(response.status_code))
+    return response
+
 
 @app.route('/', methods=['GET'])
 def home():
@@ -33,11 +62,17 @@ def get_game_state():
     if clientId:
         core.update_ping(clientId)
 
-    return {'status': 'ok', 'game_running': game_running, 'game_id': game_id}
+    return {'status': 'ok', 'game_running': game_running, 'game_id': game_id, 'version': core.get_event_version()}
 
 
 @app.route('/api/sol', methods=['GET'])
 def get_sol():
+    # The shipped client does not name itself here, and its players keep their robots by sending
+    # plans; a client that does pass clientId also counts its polling as activity
+    clientId = request.args.get('clientId')
+    if clientId:
+        core.update_ping(clientId)
+
     sol = core.get_sol()
     if sol:
         return {'status': 'ok', 'sol': sol[0], 'total_sols': sol[1], 'mins_per_sol': sol[2]}
@@ -50,20 +85,98 @@ def set_plan():
     if form_robot:
         robot = int(form_robot)
         plan = request.form.get('plan')
-        delay = core.queue_plan(robot, plan)
+        # A client that passes clientId finds out on its next plan if its robot was reclaimed
+        clientId = request.form.get('clientId')
+        if clientId and core.get_state().client_robots.get(clientId) != robot:
+            return {'status': 'fail', 'message': f'Robot {robot} is no longer assigned to you'}
+        try:
+            delay, plan_id = core.queue_plan(robot, plan)
+        except ValueError as err:
+            return {'status': 'fail', 'message': str(err)}
         if plan:
             app.logger.debug(f'plan:{request.form}')
         else:
             app.logger.debug(f'rescue:{request.form}')
-        return {'status': 'ok', 'delay': delay}
+        return {'status': 'ok', 'delay': delay, 'plan_id': plan_id}
     return {'status': 'fail', 'message': 'Missing robot id'}
 
 
-def _run_server():
-    app.run(host="0.0.0.0")
+def _push_busy():
+    _push_refused.inc()
+    return ({'status': 'fail', 'message': 'Too many clients waiting for events, poll /api/game_state instead'},
+            503, {'Retry-After': str(int(_max_wait))})
+
+
+def _event_dict(event):
+    version, name, data = event
+    return {'version': version, 'event': name, 'data': data}
+
+
+# Long-poll for changes: answers as soon as anything newer than `since` happens,
+# or after `timeout` seconds with an empty event list
+@app.route('/api/poll', methods=['GET'])
+def poll_events():
+    since = request.args.get('since', 0, type=int)
+    timeout = min(request.args.get('timeout', _max_wait, type=float), _max_wait)
+
+    clientId = request.args.get('clientId')
+    if clientId:
+        core.update_ping(clientId)
+
+    if not _push.acquire():
+        return _push_busy()
+    try:
+        version, events, complete = core.wait_for_events(since, timeout)
+    finally:
+        _push.release()
+    return {'status': 'ok', 'version': version, 'complete': complete,
+            'events': [_event_dict(e) for e in events]}
+
+
+# Server-Sent Events stream of the same change feed.
+# Reconnecting clients resume from the Last-Event-ID header.
+# A stream keeps its push slot until the client goes away and the server closes the response.
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', core.get_event_version(), type=int)
+    clientId = request.args.get('clientId')
+    if not _push.acquire():
+        return _push_busy()
+
+    def stream(since):
+        # Tell the client where the feed starts so it can resume after a disconnect
+        yield f'id: {since}\nevent: hello\ndata: {{}}\n\n'
+        while True:
+            if clientId:
+                core.update_ping(clientId)
+            version, events, complete = core.wait_for_events(since, _max_wait)
+            if not complete:
+                yield f'id: {version}\nevent: resync\ndata: {{}}\n\n'
+            for e in events:
+                yield f'id: {e[0]}\nevent: {e[1]}\ndata: {json.dumps(e[2])}\n\n'
+                if e[1] == 'shutdown':
+                    return
+            if not events:
+                yield ': keepalive\n\n'
+            since = version
+
+    response = flask.Response(stream(since), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(_push.release)
+    return response
 
 
 def start():
     global _api_server
-    _api_server = threading.Thread(target=_run_server, daemon=True)
+    _api_server = http_server.HttpServer(app, _api_host, _api_port)
     _api_server.start()
+    core.on_shutdown(stop)
+
+
+def stop():
+    global _api_server
+    if _api_server is not None:
+        _api_server.stop()
+        _api_server = None
@@ -0,0 +1,244 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import flask
+from flask import request
+
+import ad_monitor
+import http_server
+
+# Runs several independent games, one per arena, from one deployment.
+# Each arena is a complete host with its own robots, game clock, plan queue, clients and journal,
+# running headless in a worker process of its own, so arenas share nothing and an event spreads
+# across cores.  This front end starts and supervises the workers and serves the participant API
+# on one public port: /arena/<name>/... goes to that arena's worker, and /api/... to the first
+# arena, so a single table works as it always has.  Robot advertisements arrive here, the one
+# process that can listen for them, and are passed to every worker's admin API; the worker that
+# owns the robot connects to it.  A worker that dies is restarted and resumes from its journal.
+#
+# The arenas file lists each arena and the robot numbers it runs:
+#   {"arenas": [{"name": "red", "robots": [1, 2, 3]}, {"name": "blue", "robots": [4, 5, 6]}]}
+
+parser = argparse.ArgumentParser(description='Run several Marsbot arenas behind one participant API')
+parser.add_argument('--config', default=os.environ.get('MARSBOTS_ARENAS', 'arenas.json'), help='arenas file')
+parser.add_argument('--port', type=int, default=5000, help='public participant API port')
+parser.add_argument('--base-port', type=int, default=5100,
+                    help='arena n serves its API on base + 2n and its admin API on base + 2n + 1')
+parser.add_argument('--no-klaxon', action='store_true', help='do not sound the rescue klaxon')
+args = parser.parse_args()
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_journal_root = os.environ.get('MARSBOTS_JOURNAL_DIR', 'journal')
+_admin_token = os.environ.get('MARSBOTS_ADMIN_TOKEN')
+_restart_delay = 2.0  # seconds before a dead worker is started again
+_stop_timeout = 10.0  # seconds a worker has to shut down cleanly
+_proxy_timeout = 60  # longer than any long-poll the API holds open
+_ad_timeout = 2
+_hop_headers = {'connection', 'keep-alive', 'transfer-encoding', 'host'}
+_push_paths = {'api/poll', 'api/events'}  # requests that hold a front end worker while they wait
+_push = http_server.PushLimit()
+
+
+# One game table, served by a worker process
+class Arena:
+    def __init__(self, name, robots, api_port, admin_port):
+        self.name = name
+        self.robots = robots
+        self.api_port = api_port
+        self.admin_port = admin_port
+        self.process = None
+        self.restarts = 0
+        self.restart_at = None
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(MARSBOTS_ROBOTS=','.join(str(num) for num in self.robots),
+                   MARSBOTS_API_HOST='127.0.0.1', MARSBOTS_API_PORT=str(self.api_port),
+                   MARSBOTS_ADMIN_HOST='127.0.0.1', MARSBOTS_ADMIN_PORT=str(self.admin_port),
+                   MARSBOTS_JOURNAL_DIR=os.path.join(_journal_root, self.name),
+                   PYTHONUNBUFFERED='1')
+        command = [sys.executable, os.path.join(_here, 'MarsbotsHost.py'), '--headless', '--no-ads']
+        if args.no_klaxon:
+            command.append('--no-klaxon')
+        self.process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, bufsize=1)
+        threading.Thread(target=self._relay, args=(self.process,), daemon=True).start()
+        print(f'Arena {self.name}: robots {self.robots}, API port {self.api_port}, admin port {self.admin_port}')
+
+    def _relay(self, process):
+        # The worker's log, labelled with its arena
+        for line in process.stdout:
+            print(f'[{self.name}] {line}', end='')
+
+    def stop(self):
+        if not self.running():
+            return
+        if os.name == 'posix':
+            self.process.send_signal(signal.SIGINT)  # lets the worker flush its journal
+        else:
+            self.process.terminate()
+        try:
+            self.process.wait(_stop_timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+_arenas: 'dict[str, Arena]' = {}
+_default: Arena = None
+_stopping = threading.Event()
+app = flask.Flask('MarsbotsArenas')
+
+
+def _load_arenas(path):
+    global _default
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    for i, entry in enumerate(config['arenas']):
+        arena = Arena(entry['name'], [int(num) for num in entry['robots']],
+                      args.base_port + 2 * i, args.base_port + 2 * i + 1)
+        _arenas[arena.name] = arena
+        if _default is None:
+            _default = arena
+
+
+def _proxy(arena, path):
+    # Long-polls and event streams for every arena share the front end's slots, so they cannot
+    # starve its workers and with them every arena's plans
+    push = path in _push_paths
+    if push and not _push.acquire():
+        return ({'status': 'fail', 'message': 'Too many clients waiting for events, poll /api/game_state instead'},
+                503, {'Retry-After': str(_proxy_timeout // 2)})
+    release = _push.release if push else (lambda: None)
+
+    conn = http.client.HTTPConnection('127.0.0.1', arena.api_port, timeout=_proxy_timeout)
+    target = '/' + path
+    if request.query_string:
+        target += '?' + request.query_string.decode('latin-1')
+    headers = {name: value for name, value in request.headers if name.lower() not in _hop_headers}
+    try:
+        conn.request(request.method, target, body=request.get_data(), headers=headers)
+        resp = conn.getresponse()
+    except OSError:
+        conn.close()
+        release()
+        return {'status': 'fail', 'message': f'Arena {arena.name} is not running'}, 503
+
+    # Streamed through as it arrives, so event streams and long-polls pass straight on
+    def body():
+        try:
+            while True:
+                chunk = resp.read1(8192)
+                if not chunk:
+                    return
+                yield chunk
+        except (OSError, http.client.HTTPException):
+            return  # the worker went away mid-response
+        finally:
+            conn.close()
+
+    response = flask.Response(body(), status=resp.status,
+                              headers=[(name, value) for name, value in resp.getheaders()
+                                       if name.lower() not in _hop_headers])
+    response.call_on_close(release)
+    return response
+
+
+@app.route('/arenas', methods=['GET'])
+def list_arenas():
+    return {'status': 'ok',
+            'arenas': [{'name': arena.name, 'robots': arena.robots, 'running': arena.running(),
+                        'restarts': arena.restarts} for arena in _arenas.values()]}
+
+
+@app.route('/arena/<name>/', methods=['GET', 'POST'], defaults={'path': ''})
+@app.route('/arena/<name>/<path:path>', methods=['GET', 'POST'])
+def arena_request(name, path):
+    arena = _arenas.get(name)
+    if arena is None:
+        return {'status': 'fail', 'message': f'No arena called {name}'}, 404
+    return _proxy(arena, path)
+
+
+@app.route('/', methods=['GET'], defaults={'path': ''})
+@app.route('/api/<path:path>', methods=['GET', 'POST'])
+def default_arena_request(path):
+    return _proxy(_default, 'api/' + path if path else '')
+
+
+def _found_robot(name, ip, port):
+    # Offers the advertisement to every arena; only the one that owns the robot takes it
+    form = {'name': name, 'ip': ip}
+    if port:
+        form['port'] = port
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if _admin_token:
+        headers['X-Admin-Token'] = _admin_token
+    for arena in _arenas.values():
+        if not arena.running():
+            continue
+        conn = http.client.HTTPConnection('127.0.0.1', arena.admin_port, timeout=_ad_timeout)
+        try:
+            conn.request('POST', '/admin/found_robot', body=urlencode(form), headers=headers)
+            if json.loads(conn.getresponse().read()).get('status') == 'ok':
+                return
+        except (OSError, ValueError) as err:
+            print(f'Could not pass robot {name} on to arena {arena.name}: {repr(err)}')
+        finally:
+            conn.close()
+    print(f'Robot {name} is not in any arena')
+
+
+def _supervise():
+    while not _stopping.wait(1.0):
+        now = time.monotonic()
+        for arena in _arenas.values():
+            if arena.running() or _stopping.is_set():
+                continue
+            if arena.restart_at is None:
+                print(f'Arena {arena.name} worker exited with code {arena.process.returncode}, restarting')
+                arena.restart_at = now + _restart_delay
+            elif now >= arena.restart_at:
+                arena.restart_at = None
+                arena.restarts += 1
+                arena.start()
+
+
+def main():
+    _load_arenas(args.config)
+    if not _arenas:
+        # Plain /api/... and the robot advertisements need somewhere to go
+        sys.exit(f'No arenas are listed in {args.config}; add at least one to run')
+    for arena in _arenas.values():
+        arena.start()
+    threading.Thread(target=_supervise, name='supervisor', daemon=True).start()
+
+    server = http_server.HttpServer(app, '0.0.0.0', args.port)
+    server.start()
+    ad_monitor.start(_found_robot)
+
+    # Ctrl-C or a service manager's SIGTERM both stop the workers cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: _stopping.set())
+    print(f'Serving {len(_arenas)} arenas, press Ctrl-C to stop')
+    try:
+        while not _stopping.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        _stopping.set()
+    server.stop()
+    for arena in _arenas.values():
+        arena.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+
+# Participants the host knows about, and which robot each one has.
+# A client is remembered from its first robot_assignment request.  One that has been silent for
+# MARSBOTS_CLIENT_IDLE seconds without a robot is forgotten, and beyond MARSBOTS_MAX_CLIENTS the
+# longest silent go first; a browser refresh or a closed laptop leaves nothing behind for long.
+# Clients with a robot are never evicted, the operator releases them.
+# Robots and clients are indexed both ways, so either lookup is a single dict read.
+# Clients without a robot wait for one in a first come, first served list.
+#
+# Not thread safe on its own: core makes every call holding its _lock, except touch.
+
+_idle_timeout = float(os.environ.get('MARSBOTS_CLIENT_IDLE', 900))
+_max_clients = int(os.environ.get('MARSBOTS_MAX_CLIENTS', 500))
+
+
+class ClientRegistry:
+    def __init__(self, idle_timeout=_idle_timeout, max_clients=_max_clients):
+        self.idle_timeout = idle_timeout
+        self.max_clients = max_clients
+        self._last_seen: 'dict[str, float]' = {}  # clientId -> time of its last request, oldest first
+        self._client_robots: 'dict[str, int]' = {}
+        self._robot_clients: 'dict[int, str]' = {}
+        self._waiting: 'dict[str, float]' = {}  # clientId -> time it joined the waitlist, first come first
+        self._assigned_at: 'dict[str, float]' = {}
+
+    def __contains__(self, clientId):
+        return clientId in self._last_seen
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def clients(self):
+        return self._last_seen.keys()
+
+    def client_robots(self):
+        return self._client_robots
+
+    def robot_clients(self):
+        return self._robot_clients
+
+    def waitlist(self):
+        return self._waiting.keys()
+
+    def joined(self, clientId):
+        return self._waiting.get(clientId)
+
+    def assigned_at(self, clientId):
+        return self._assigned_at.get(clientId)
+
+    def add(self, clientId, now):
+        # Remembers a client and puts it on the waitlist, returning whatever had to be evicted to make room
+        self._last_seen[clientId] = now
+        self._waiting[clientId] = now
+        if len(self._last_seen) <= self.max_clients:
+            return []
+        return self._evict_oldest(len(self._last_seen) - self.max_clients)
+
+    def touch(self, clientId, now):
+        # Safe without core's lock: it only stores into an existing entry, a single atomic dict store,
+        # and everything that walks the clients works on a copy.  A client evicted at the same
+        # moment may be remembered again, to be forgotten by the next sweep.
+        if clientId in self._last_seen:
+            self._last_seen[clientId] = now
+
+    def join(self, clientId, now):
+        # Puts a known client without a robot back on the end of the waitlist; False if it need not be
+        if clientId not in self._last_seen or clientId in self._client_robots or clientId in self._waiting:
+            return False
+        self._waiting[clientId] = now
+        return True
+
+    def last_seen(self, clientId):
+        return self._last_seen.get(clientId)
+
+    def robot_of(self, clientId):
+        return self._client_robots.get(clientId)
+
+    def client_of(self, number):
+        return self._robot_clients.get(number)
+
+    def assign(self, clientId, number, now):
+        # Returns how long the client waited for the robot, or None if either is already assigned
+        if clientId in self._client_robots or number in self._robot_clients:
+            return None
+        if clientId not in self._last_seen:
+            self._last_seen[clientId] = now
+        self._client_robots[clientId] = number
+        self._robot_clients[number] = clientId
+        self._assigned_at[clientId] = now
+        return now - self._waiting.pop(clientId, now)
+
+    def release_client(self, clientId):
+        # Returns the robot the client had, or None
+        number = self._client_robots.pop(clientId, None)
+        if number is not None:
+            del self._robot_clients[number]
+            del self._assigned_at[clientId]
+        return number
+
+    def release_robot(self, number):
+        # Returns the client that had the robot, or None
+        clientId = self._robot_clients.pop(number, None)
+        if clientId is not None:
+            del self._client_robots[clientId]
+            del self._assigned_at[clientId]
+        return clientId
+
+    def release_all(self):
+        # Returns [(clientId, robot number)] for every assignment there was
+        released = list(self._client_robots.items())
+        self._client_robots.clear()
+        self._robot_clients.clear()
+        self._assigned_at.clear()
+        return released
+
+    def evict_idle(self, now):
+        # Forgets unassigned clients silent for longer than the idle timeout, returning them
+        idle = [clientId for clientId, seen in list(self._last_seen.items())
+                if now - seen > self.idle_timeout and clientId not in self._client_robots]
+        for clientId in idle:
+            del self._last_seen[clientId]
+            self._waiting.pop(clientId, None)
+        return idle
+
+    def _evict_oldest(self, count):
+        candidates = sorted((seen, clientId) for clientId, seen in list(self._last_seen.items())
+                            if clientId not in self._client_robots)
+        evicted = [clientId for _, clientId in candidates[:count]]
+        for clientId in evicted:
+            del self._last_seen[clientId]
+            self._waiting.pop(clientId, None)
+        return evicted
@@ -0,0 +1,51 @@
+import time
+
+# Game clocks.
+# now() returns seconds on the clock's own timeline; only differences between readings
+# are meaningful.  wait(cond, timeout) blocks on a held Condition for up to timeout seconds
+# of clock time, or until notified.  Manual clocks never pass time on their own; whoever
+# owns them moves them forward, as Scheduler.run_until does.
+
+
+# Production clock: never jumps when the system time is adjusted
+class MonotonicClock:
+    manual = False
+
+    def now(self):
+        return time.monotonic()
+
+    def wait(self, cond, timeout):
+        cond.wait(timeout)
+
+
+# Runs `scale` times faster than real time, so a 30 minute game can play out in seconds
+class ScaledClock:
+    manual = False
+
+    def __init__(self, scale: float):
+        self.scale = scale
+        self._origin = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self._origin) * self.scale
+
+    def wait(self, cond, timeout):
+        cond.wait(None if timeout is None else timeout / self.scale)
+
+
+# Only moves when told to, for deterministic simulation and replay
+class VirtualClock:
+    manual = True
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def advance_to(self, t: float):
+        if t > self._now:
+            self._now = t
+
+    def wait(self, cond, timeout):
+        raise RuntimeError('A virtual clock cannot be waited on; advance it instead')
@@ -1,7 +1,9 @@
+import time
+from collections import deque
 import PySimpleGUI as sg
 import core
 import get_public_ip
-import sound
+import metrics
 
 
 # configure frame keys
@@ -14,11 +16,52 @@ _long_trip_time_key = '-LONG-TRIP-TIME-'
 # main window keys
 _start_button_key = '-START-'
 _abort_button_key = '-ABORT-'
+_reconnect_all_key = '-RECONNECT-ALL-'
+_reload_fleet_key = '-RELOAD-FLEET-'
+_fleet_size_key = '-FLEET-SIZE-'
+_robots_column_key = '-ROBOTS-'
+_pending_text_key = '-PENDING-TEXT-'
+_pending_key = '-PENDING-ROBOT-'
+_add_robot_key = '-ADD-ROBOT-'
+_ignore_robot_key = '-IGNORE-ROBOT-'
+_auto_assign_key = '-AUTO-ASSIGN-'
+_waitlist_key = '-WAITLIST-'
 _sol_key = '-SOL-MESSAGE-'
+_frame_key = '-FRAME-TIME-'
 
 # robot assignment keys
 _client_frame_key = '-CLIENTS-FRAME'
 
+# Time the operator loop spends refreshing the window, and handling what the operator did
+_loop_seconds = metrics.histogram('marsbots_gui_loop_seconds', 'Operator console loop time, excluding idle waits',
+                                  ['phase'])
+_frame_stats_size = 20  # frames averaged for the frame time display
+
+
+# Renders the console by difference.  Each widget's last update is remembered and an identical
+# update is skipped, so a frame only touches the widgets whose value actually changed.
+class _View:
+    def __init__(self, window):
+        self._window = window
+        self._applied: 'dict[str, tuple]' = {}
+        self.updates = 0  # widgets touched since last reset
+
+    def update(self, key, *args, **kwargs):
+        value = (args, kwargs)
+        if self._applied.get(key) == value:
+            return
+        self._applied[key] = value
+        self._window[key].update(*args, **kwargs)
+        self.updates += 1
+
+    def forget(self, key):
+        self._applied.pop(key, None)
+
+
+def _robot_pane_key(number):
+    return f'-ROBOT-PANE-{number}-'
+
+
 def _connected_key(number):
     return f'-ROBOT-CONNECTED-{number}-'
 
@@ -26,21 +69,52 @@ def _connected_key(number):
 def _rescue_key(number):
     return f'-ROBOT-RESCUE-{number}-'
 
-def _robot_assign_key(clientId: str) -> str:
-    return f'-CLIENTS-ASSIGN-{clientId}'
 
-def _client_ping_key(clientId: str) -> str:
-    return f'-CLIENTS-PING-{clientId}'
+def _link_key(number):
+    return f'-ROBOT-LINK-{number}-'
+
+
+def _telemetry_key(number):
+    return f'-ROBOT-TELEMETRY-{number}-'
 
-def _parse_robot_assign_key(robot_assign_key: str) -> str:
-    return robot_assign_key[len('-CLIENTS-ASSIGN-'):]
+def _client_row_key(slot: int) -> str:
+    return f'-CLIENTS-ROW-{slot}-'
+
+def _client_name_key(slot: int) -> str:
+    return f'-CLIENTS-NAME-{slot}-'
+
+def _robot_assign_key(slot: int) -> str:
+    return f'-CLIENTS-ASSIGN-{slot}-'
+
+def _client_ping_key(slot: int) -> str:
+    return f'-CLIENTS-PING-{slot}-'
 
 def _robot_pane(number, label):
     layout = [
         [sg.Button('Disconnected', key=_connected_key(number), pad=(10, 10))],
+        [sg.Text('', size=(40, 1), key=_link_key(number), justification='center')],
+        [sg.Text('', size=(40, 1), key=_telemetry_key(number), justification='center')],
         [sg.Button(f'Rescue {number}', size=(15, 1), key=_rescue_key(number), pad=(20, 10), disabled=True)]
     ]
-    return sg.Frame(f'Robot {number}  -  {label}', layout, border_width=1, pad=(20, 10), element_justification='center')
+    return sg.pin(sg.Frame(_robot_title(number, label), layout, key=_robot_pane_key(number), border_width=1,
+                           pad=(20, 10), element_justification='center'))
+
+def _robot_title(number, label):
+    return f'Robot {number}  -  {label}'
+
+def _robot_rows(panes):
+    return [panes[i:i + 3] for i in range(0, len(panes), 3)]
+
+def _telemetry_text(telemetry, held: int, dropped: int) -> str:
+    if telemetry.last_heard is None:
+        return 'No telemetry'
+    if telemetry.error:
+        return f'Error: {telemetry.error}'
+    activity = f'Plan {telemetry.plan_id} step {telemetry.step}/{telemetry.steps}' if telemetry.plan_id else 'Idle'
+    waiting = f' +{held} held' if held else ''
+    waiting += f' ({dropped} dropped)' if dropped else ''
+    latency = f'  Ack {telemetry.latency * 1000:.0f} ms' if telemetry.latency is not None else ''
+    return f'{activity}{waiting}  {telemetry.battery:.1f} V{latency}'
 
 def _robot_id_to_str(id: int) -> str:
     return f'Robot {id}'
@@ -48,27 +122,84 @@ def _robot_id_to_str(id: int) -> str:
 def _robot_id_from_str(formatted: str) -> int:
     return int(formatted[len('Robot '):])
 
-def _client_row(clientId: str, robots: 'list[int]'):
-    return [[
-        sg.Text(clientId, size=(40, 1)),
-        sg.Text("Last ping (sec): ???", size=(20, 1), key=_client_ping_key(clientId)),
-        sg.Combo(['NONE'] + [_robot_id_to_str(robot) for robot in robots], default_value='NONE', readonly=True, key=_robot_assign_key(clientId), enable_events=True)
-    ]]
+def _client_row(slot: int, robots: 'list[int]'):
+    return [[sg.pin(sg.Column([[
+        sg.Text('', size=(40, 1), key=_client_name_key(slot)),
+        sg.Text("Last ping (sec): ???", size=(20, 1), key=_client_ping_key(slot)),
+        sg.Combo(['NONE'] + [_robot_id_to_str(robot) for robot in robots], default_value='NONE', readonly=True, key=_robot_assign_key(slot), enable_events=True)
+    ]], key=_client_row_key(slot)))]]
+
+
+# Client rows are pooled.  A forgotten client's row is hidden and handed to the next new client,
+# so the window only ever holds as many rows as there were clients known at once.
+class _ClientRows:
+    def __init__(self, window, view, robots: 'list[int]'):
+        self._window = window
+        self._view = view
+        self._robots = robots
+        self.slot_clients: 'dict[int, str]' = {}
+        self.client_slots: 'dict[str, int]' = {}
+        self._free: 'list[int]' = []
+        self._slots = 0
+
+    def sync(self, known: 'frozenset[str]'):
+        for client in [client for client in self.client_slots if client not in known]:
+            slot = self.client_slots.pop(client)
+            del self.slot_clients[slot]
+            self._free.append(slot)
+            self._view.update(_client_row_key(slot), visible=False)
+        for client in sorted(known - self.client_slots.keys()):
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = self._slots
+                self._slots += 1
+                self._window.extend_layout(self._window[_client_frame_key], _client_row(slot, self._robots))
+            self.client_slots[client] = slot
+            self.slot_clients[slot] = client
+            self._view.update(_client_name_key(slot), client)
+            self._view.update(_client_row_key(slot), visible=True)
+
+    def set_robots(self, robots: 'list[int]'):
+        # The fleet has changed, so every row offers the new robots
+        self._robots = robots
+        choices = ['NONE'] + [_robot_id_to_str(robot) for robot in robots]
+        for slot in range(self._slots):
+            self._window[_robot_assign_key(slot)].update(values=choices)
+            self._view.forget(_robot_assign_key(slot))
+
+
+# A pane is made for each robot as it joins the fleet.  A robot that leaves has its pane hidden,
+# and shown again if it comes back.
+class _RobotPanes:
+    def __init__(self, window, view, numbers: 'list[int]'):
+        self._window = window
+        self._view = view
+        self.numbers = numbers
+        self._made = set(numbers)
+
+    def sync(self, numbers: 'list[int]'):
+        # Returns whether the robots in the fleet have changed
+        for num in self.numbers:
+            if num not in numbers:
+                self._view.update(_robot_pane_key(num), visible=False)
+        new = [num for num in numbers if num not in self._made]
+        if new:
+            self._window.extend_layout(self._window[_robots_column_key],
+                                       _robot_rows([_robot_pane(num, core.get_robot_label(num)) for num in new]))
+            self._made.update(new)
+        for num in numbers:
+            self._view.update(_robot_pane_key(num), _robot_title(num, core.get_robot_label(num)), visible=True)
+        changed = numbers != self.numbers
+        self.numbers = numbers
+        return changed
 
 def _display_game():
     numbers = core.get_valid_robot_numbers()
     public_ip = get_public_ip.get_public_ip()
     mins, sols, short, long = core.get_game_config()
 
-    robot_panes = []
-    row_panes = []
-    for num in numbers:
-        row_panes.append(_robot_pane(num, core.get_robot_label(num)))
-        if len(row_panes) == 3:
-            robot_panes.append(row_panes)
-            row_panes = []
-    if len(row_panes) > 0:
-        robot_panes.append(row_panes)
+    robot_panes = _robot_rows([_robot_pane(num, core.get_robot_label(num)) for num in numbers])
 
     config_layout = [
         [sg.Column([
@@ -81,14 +212,24 @@ def _display_game():
     ]
 
     layout = [
-        [sg.Text(f"Known robots: {len(numbers)}", size=(40, 1), justification='left'),
-         sg.Text(f"Public IP: {public_ip}", size=(40, 1), justification='right')],
+        [sg.Text(f"Known robots: {len(numbers)}", size=(40, 1), key=_fleet_size_key, justification='left'),
+         sg.Text(f"Public IP: {public_ip}", size=(40, 1), justification='right'),
+         sg.Text('', size=(25, 1), key=_frame_key, justification='right')],
         [sg.Frame('Game Configuration', config_layout, key=_config_frame_key, border_width=1, pad=(20, 10))],
         [sg.Button('Start', size=(20, 1), key=_start_button_key),
-         sg.Button('Abort', key=_abort_button_key)],
+         sg.Button('Abort', key=_abort_button_key),
+         sg.Button('Reconnect all', key=_reconnect_all_key),
+         sg.Button('Reload fleet', key=_reload_fleet_key)],
         [sg.Column([[sg.Text(size=(20, 1), key=_sol_key, font=('Sans', 24), justification='center')]],
                    justification='center')],
-        [sg.Column(robot_panes, justification='center')],
+        [sg.Column(robot_panes, key=_robots_column_key, justification='center')],
+        [sg.Text('', size=(40, 1), key=_pending_text_key),
+         sg.Combo([], size=(30, 1), readonly=True, key=_pending_key),
+         sg.Button('Add to fleet', key=_add_robot_key, disabled=True),
+         sg.Button('Ignore', key=_ignore_robot_key, disabled=True)],
+        [sg.Checkbox('Assign robots automatically', default=core.get_state().auto_assign, key=_auto_assign_key,
+                     enable_events=True),
+         sg.Text('', size=(60, 1), key=_waitlist_key)],
         [sg.Frame('Clients', [[]], key=_client_frame_key, border_width=1, pad=(20, 10))]
     ]
     window = sg.Window('Shared Science Mars Adventure', layout, font=('Sans', 10),
@@ -100,70 +241,103 @@ def run_game():
     window = _display_game()
     numbers = core.get_valid_robot_numbers()
     def_color = sg.Button().ButtonColor
+    view = _View(window)
+    frame_times: 'deque[float]' = deque(maxlen=_frame_stats_size)
 
     flash = False
 
-    registered_clients: 'set[str]' = set()
+    client_rows = _ClientRows(window, view, numbers)
+    robot_panes = _RobotPanes(window, view, numbers)
+    seen_version = None
 
     running = True
     while running:
-        active = core.is_game_running()
+        refresh_start = time.perf_counter()
+        view.updates = 0
 
-        # Process any pending plans or rescues
-        core.process_queue()
+        # The engine may end the game at any moment, so read the sol once
+        sol = core.get_sol()
+        active = sol is not None
 
         # Update Sol timer
         if active:
-            sol_now, sol_total, mins_per_sol = core.get_sol()
-            if sol_now > sol_total + 1:
-                core.abort_game()
-            window[_sol_key].update(f'Sol {sol_now:.1f} of {sol_total:.0f}', visible=True)
+            sol_now, sol_total, mins_per_sol = sol
+            view.update(_sol_key, f'Sol {sol_now:.1f} of {sol_total:.0f}', visible=True)
         else:
-            window[_sol_key].update(visible=False)
+            view.update(_sol_key, visible=False)
 
         # Manage Button states
-        window[_config_frame_key].update(visible=not active)
-        window[_start_button_key].update(disabled=active)
-        window[_abort_button_key].update(disabled=not active)
-        any_rescues = False
+        view.update(_config_frame_key, visible=not active)
+        view.update(_start_button_key, disabled=active)
+        view.update(_abort_button_key, disabled=not active)
         flash = not flash
+        state = core.get_state()
         for num in numbers:
             # connected
+            health, rtt_ms, jitter_ms, silent = core.get_link_health(num)
             connected = core.get_connected(num)
             color = ('green', None) if connected else ('red', None)
             text = 'Connected' if connected else 'Disconnected'
-            window[_connected_key(num)].update(text, button_color=color)
+            if connected and health == 'degraded':
+                color = ('black', 'orange')
+                text = 'Degraded'
+            view.update(_connected_key(num), text, button_color=color)
+            depth, last_ms, mean_ms, dropped, connect_ms = core.get_link_stats(num)
+            view.update(_link_key(num),
+                        f'RTT {rtt_ms:.0f}\u00b1{jitter_ms:.0f} ms  Queue {depth}  Dropped {dropped}  Connect {connect_ms:.0f} ms')
+            telemetry = core.get_robot_telemetry(num)
+            held, _, _, _, held_dropped = core.get_dispatch_queue(num)
+            view.update(_telemetry_key(num), _telemetry_text(telemetry, held, held_dropped),
+                        text_color='red' if telemetry.error else sg.theme_text_color())
             # rescue
-            rescue = core.get_rescue(num)
+            rescue = num in state.rescues
             light = flash and rescue
-            any_rescues = any_rescues or light
             color = ('white', 'red') if light else def_color
-            window[_rescue_key(num)].update(button_color=color, disabled=not rescue)
-
-        if any_rescues:
-            sound.alert()
-
-        # Manage robot assignment
-        clients = core.get_known_clients()
-        for client in clients:
-            if client not in registered_clients:
-                window.extend_layout(window[_client_frame_key], _client_row(client, numbers))
-                registered_clients.add(client)
-
+            view.update(_rescue_key(num), button_color=color, disabled=not rescue)
+
+        # Manage the fleet and robot assignment.  Both only change with the game state's version.
+        if state.version != seen_version:
+            seen_version = state.version
+            if robot_panes.sync(list(state.robots)):
+                numbers = robot_panes.numbers
+                client_rows.set_robots(numbers)
+                view.update(_fleet_size_key, f'Known robots: {len(numbers)}')
+            pending = list(state.pending_robots)
+            view.update(_pending_text_key, f'Robots waiting to join the fleet: {len(pending)}' if pending else '')
+            view.update(_pending_key, values=pending, value=pending[0] if pending else '')
+            view.update(_add_robot_key, disabled=not pending)
+            view.update(_ignore_robot_key, disabled=not pending)
+            client_rows.sync(state.known_clients)
+            view.update(_auto_assign_key, value=state.auto_assign)
+
+        waitlist = core.get_waitlist()
+        mean_wait, max_wait = core.get_assignment_waits()
+        longest = f', longest {waitlist[0][1]:.0f} s' if waitlist else ''
+        view.update(_waitlist_key, f'Waiting for a robot: {len(waitlist)}{longest}  '
+                                   f'Recent waits: mean {mean_wait:.0f} s, max {max_wait:.0f} s')
+
+        for slot, client in client_rows.slot_clients.items():
             last_ping = core.get_last_client_ping(client)
-            text = f'Last ping (sec): {last_ping:.1f}' if last_ping else 'Last ping (sec): N/A'
-            window[_client_ping_key(client)].update(text)
+            text = f'Last ping (sec): {last_ping:.0f}' if last_ping is not None else 'Last ping (sec): N/A'
+            view.update(_client_ping_key(slot), text)
+            robot = state.client_robots.get(client)
+            view.update(_robot_assign_key(slot), value=_robot_id_to_str(robot) if robot else 'NONE')
+
+        # Frame time over recent frames, and how many widgets this one touched
+        frame_time = time.perf_counter() - refresh_start
+        frame_times.append(frame_time)
+        view.update(_frame_key, f'Frame {sum(frame_times) * 1000 / len(frame_times):.1f} ms, '
+                                f'{view.updates} updates')
 
         # Wait for window events
         # timeout allows the Sol timer to update like a clock and the buttons to flash
+        _loop_seconds.observe(frame_time, 'refresh')
         event, values = window.read(timeout=500)
+        events_start = time.perf_counter()
         if event == sg.WINDOW_CLOSE_ATTEMPTED_EVENT \
                 and sg.popup_yes_no('Do you really want to exit?', font=('Sans', 18)) == 'Yes':
             break
 
-        # Keep robots alive
-        core.ping_robots()
-
         # Process any button events
         if event not in (sg.TIMEOUT_EVENT, sg.WIN_CLOSED):
             key_split = event.strip('-').split('-')
@@ -189,13 +363,29 @@ def run_game():
                 core.start_game()
             elif event == _abort_button_key:
                 core.abort_game()
-            elif len(key_split) > 2 and key_split[0] == 'CLIENTS' and key_split[1] == 'ASSIGN':
-                client = _parse_robot_assign_key(event)
+            elif event == _reconnect_all_key:
+                core.reconnect_all()
+            elif event == _reload_fleet_key:
+                core.reload_fleet()
+            elif event == _add_robot_key and values[_pending_key]:
+                number, message = core.confirm_robot(values[_pending_key])
+                if number is None:
+                    sg.popup(message)
+            elif event == _ignore_robot_key and values[_pending_key]:
+                core.ignore_robot(values[_pending_key])
+            elif event == _auto_assign_key:
+                view.forget(event)
+                core.set_auto_assign(values[event])
+            elif len(key_split) == 3 and key_split[0] == 'CLIENTS' and key_split[1] == 'ASSIGN':
+                # The operator has changed the widget, so its next update must not be skipped
+                view.forget(event)
+                client = client_rows.slot_clients.get(int(key_split[2]))
                 value = values[event]
-                if value == 'NONE':
+                if client and value == 'NONE':
                     core.release_robot_from_client(client)
-                else:
+                elif client:
                     robot = _robot_id_from_str(value)
                     core.assign_robot(robot, client)
+        _loop_seconds.observe(time.perf_counter() - events_start, 'events')
 
     window.close()
@@ -1,9 +1,20 @@
 import threading
 import time
 import uuid
+from collections import deque, namedtuple
+from types import MappingProxyType
 
 import os
 
+import clients
+import clock
+import fleet
+import journal
+import metrics
+import protocol
+import robot_model
+import scheduler
+
 if 'MOCK_ROBOT' in os.environ and bool(os.environ['MOCK_ROBOT']):
     from mock_robot import MockRobot
     RobotClass = MockRobot
@@ -11,18 +22,9 @@ else:
     from remote_robot import RemoteRobot
     RobotClass = RemoteRobot
 
-# Robot IDs
-#  id - Robot Number is the highly legible flag on the robot
-#  btmac - Mac address of the EV3's bluetooth
-#  name - Sticker label on the EV3
-_robot_ids = [
-    {'id': 1, 'name': 'ev3dev-ssci-25', 'btmac': '00:17:E9:B3:E3:57'},
-    {'id': 2, 'name': 'ev3dev-ssci-26', 'btmac': '00:17:E9:B3:E4:C8'},
-    {'id': 3, 'name': 'ev3dev-ssci-27', 'btmac': '00:17:E9:BA:AE:97'},
-    {'id': 4, 'name': 'ev3dev-ssci-29', 'btmac': '00:17:EC:02:E7:37'},
-    {'id': 5, 'name': 'ev3dev-ssci-32', 'btmac': '40:BD:32:3B:A6:A0'},
-    {'id': 6, 'name': 'ev3dev-ssci-33', 'btmac': '40:BD:32:3B:A3:81'}
-]
+# The robots this host runs, from the fleet file
+_fleet = fleet.Fleet()
+_fleet_error = None  # why the fleet file last failed to load, reported once per failure
 
 # Config params
 _game_minutes = 30
@@ -32,141 +34,644 @@ _long_trip = 20
 _mins_per_sol = 1
 _delay_scale = 1
 
-# Active robots
-_robots: 'dict[str,_Robot]' = {}
-
-# Map clients to their assigned robot
-_client_robots: 'dict[str,str]' = {}
+# Active robots.  Replaced whole when the fleet changes, never changed in place, so it can be
+# iterated without _lock.
+_robots: 'dict[int, _Robot]' = {}
 
-_client_pings: 'dict[str, float]' = {}
+# Known clients and their robots
+_clients = clients.ClientRegistry()
 
-_known_clients: 'set[str]' = set()
+# Automatic assignment.  While it is on, free connected robots go to the clients that have waited
+# longest and are still calling.  During a game, a player silent for MARSBOTS_CLIENT_STALE seconds,
+# counting plans as well as pings, loses their robot to a waiting client when there is no free robot
+# for them; before a game nobody is reclaimed, since a seated player only polls /api/sol.  At the end
+# of each game the longest serving players make way for those waiting.  The operator can still
+# assign and release by hand, or turn it off.
+_auto_assign = os.environ.get('MARSBOTS_AUTO_ASSIGN', '1') != '0'
+_stale_after = float(os.environ.get('MARSBOTS_CLIENT_STALE', 300))
+_assign_waits: 'deque[float]' = deque(maxlen=64)  # recent seconds from joining the waitlist to getting a robot
 
 # Game timer
 _game_running = False
 _game_id: str = uuid.uuid1()
 _sol_rt_base = 0.0
+_wall_base = 0.0  # time.time() at the start of the game, for the journal
+
+# Instrumentation, rendered by admin_host at /metrics
+_lock_wait = metrics.histogram('marsbots_lock_wait_seconds', 'Time spent waiting to take a core lock', ['lock'])
+_queue_plan_time = metrics.histogram('marsbots_queue_plan_seconds', 'Time to check, encode and queue a plan')
+_plans_queued = metrics.counter('marsbots_plans_queued_total', 'Plans and rescues queued for the light delay',
+                                ['kind'])
+_send_plan_time = metrics.histogram('marsbots_send_plan_seconds', 'Time to hand a due plan to its robot link')
+_plans_sent = metrics.counter('marsbots_plans_sent_total', 'Plans handed to a robot link', ['result'])
 
 # Thread safety
-_lock = threading.Lock()
+_lock = metrics.TimedLock(_lock_wait, 'core')
 
-# Event queue
-_queue = []
+# Game time.  Monotonic in production; MARSBOTS_TIME_SCALE runs games faster for simulation
+if os.environ.get('MARSBOTS_TIME_SCALE'):
+    _clock = clock.ScaledClock(float(os.environ['MARSBOTS_TIME_SCALE']))
+else:
+    _clock = clock.MonotonicClock()
+
+# Plan queue, dispatched at each plan's due time
+_queue = scheduler.Scheduler(_clock)
+
+# Immutable, versioned view of the game published on every state change.
+# Readers take the current snapshot with a single reference read and never touch _lock;
+# writers rebuild it while holding _lock.
+GameState = namedtuple('GameState', [
+    'version',
+    'game_running', 'game_id',
+    'game_minutes', 'game_sols', 'short_trip', 'long_trip',
+    'sol_rt_base', 'mins_per_sol', 'secs_per_sol', 'delay_scale',
+    'client_robots',  # clientId -> robot number
+    'robot_clients',  # robot number -> clientId
+    'known_clients',
+    'rescues',
+    'waitlist',  # clientIds waiting for a robot, first come first
+    'auto_assign',
+    'robots',  # robot numbers in the fleet, in order
+    'pending_robots',  # names of robots that advertised and wait to be added to the fleet
+])
+
+_state: GameState = None
+
+# Latest telemetry from a robot, replaced whole on every update so readers never see it half written
+RobotTelemetry = namedtuple('RobotTelemetry', [
+    'last_heard',  # time.monotonic() of the last message, None if never heard from
+    'battery',  # volts
+    'left', 'right',  # wheel encoder degrees
+    'plan_id', 'step', 'steps',  # plan being run, 1-based step and step count; plan_id 0 when idle
+    'latency',  # seconds from handing the last plan to the link until the robot accepted it
+    'run_time',  # seconds the last finished plan took on the robot
+    'error',  # last error, cleared when the robot accepts its next plan
+])
+
+_no_telemetry = RobotTelemetry(None, 0.0, 0, 0, 0, 0, 0, None, None, '')
+
+# Plan ids tie a plan to the robot's telemetry about it
+_last_plan_id = 0
+_sent_plans_size = 32  # plans per robot awaiting acceptance
+
+# Per-robot dispatch.  A plan that comes due while its robot is still running the previous one
+# is held until the robot reports it done, or until its estimated run time plus _busy_margin has
+# passed without word.  At most _max_held plans wait per robot; beyond that the oldest is dropped.
+_max_held = 3
+_busy_margin = 2.0  # seconds
+_dispatch_lock = metrics.TimedLock(_lock_wait, 'dispatch')
+_wait_stats_size = 32
+
+# Plans and rescues queued for the light delay and not yet due, as the journal holds them.
+# Guarded by _dispatch_lock.
+_in_flight: 'dict[int, dict]' = {}
+
+# Called by shutdown() before the robots are disconnected
+_shutdown_hooks = []
+
+# Change feed pushed to clients: (version, event name, data)
+_event_history = 1000
+_events = deque(maxlen=_event_history)
+_event_version = 0
+_event_cond = threading.Condition()
+
+
+def _publish_state():
+    # Must be called holding _lock
+    global _state
+    _state = GameState(
+        version=_state.version + 1 if _state else 1,
+        game_running=_game_running, game_id=_game_id,
+        game_minutes=_game_minutes, game_sols=_game_sols, short_trip=_short_trip, long_trip=_long_trip,
+        sol_rt_base=_sol_rt_base, mins_per_sol=_mins_per_sol, secs_per_sol=_mins_per_sol * 60.0,
+        delay_scale=_delay_scale,
+        client_robots=MappingProxyType(dict(_clients.client_robots())),
+        robot_clients=MappingProxyType(dict(_clients.robot_clients())),
+        known_clients=frozenset(_clients.clients()),
+        rescues=frozenset(num for num, r in _robots.items() if r.rescue),
+        waitlist=tuple(_clients.waitlist()),
+        auto_assign=_auto_assign,
+        robots=tuple(sorted(_robots)),
+        pending_robots=tuple(_fleet.pending()),
+    )
+
+
+def get_state() -> GameState:
+    return _state
+
+
+with _lock:
+    _publish_state()
 
 
 class _Robot:
     def __init__(self, rid):
         self.robot = RobotClass(rid)
+        self.robot.telemetry_handler = lambda telemetry: _on_telemetry(rid['id'], telemetry)
         self.label = rid['name']
-        self.client: str = None
-        self.taken = False
         self.rescue = False
+        self.telemetry = _no_telemetry
+        self.sent_plans: 'dict[int, float]' = {}  # plan id -> time.monotonic() handed to the link
+        self.plan_started = 0.0  # robot clock when the current plan was accepted
+
+        # Dispatch queue, guarded by _dispatch_lock
+        self.held: 'deque[tuple]' = deque()  # (plan id, payload, estimated seconds, game time held)
+        self.running: 'set[int]' = set()  # plans sent and not yet reported done
+        self.busy_until = 0.0  # game time the running plan should have finished by
+        self.held_dropped = 0
+        self.waits: 'deque[float]' = deque(maxlen=_wait_stats_size)
+
+def set_clock(game_clock):
+    # Swap in another clock, e.g. a VirtualClock for simulation.  Only valid before startup().
+    global _clock, _queue
+    _clock = game_clock
+    _queue = scheduler.Scheduler(game_clock)
+
+
+def now():
+    return _clock.now()
 
-def startup():
+
+def _clock_scale():
+    # Seconds of game clock per wall clock second, for turning the journal's wall times into clock time
+    return getattr(_clock, 'scale', 1.0)
+
+
+def call_at(due, func, *args):
+    # Runs func on the scheduler at game time due
+    _queue.schedule(due, func, *args)
+
+
+def run_for(seconds):
+    # Advances a manual clock, dispatching everything that falls due on the way
+    _queue.run_until(_clock.now() + seconds)
+
+
+def startup(use_journal=True):
+    # With use_journal, a game interrupted by a crash or restart carries on from the journal
     global _robots
-    for rid in _robot_ids:
-        _robots[rid['id']] = _Robot(rid)
+    with _lock:
+        _fleet.load()
+        _robots = {rid['id']: _Robot(rid) for rid in _fleet.robots()}
+        _publish_state()
+    if use_journal:
+        start = time.perf_counter()
+        _resume(journal.load())
+        print(f'Journal loaded in {(time.perf_counter() - start) * 1000:.0f} ms')
+        journal.start(_snapshot)
+    _queue.start()
+
+
+def _snapshot():
+    # The whole game as the journal lays it out; see journal.empty_state
+    snapshot = journal.empty_state()
+    snapshot['seq'] = journal.get_seq()
+    with _lock:
+        snapshot['config'] = [_game_minutes, _game_sols, _short_trip, _long_trip]
+        snapshot['assignments'] = dict(_clients.client_robots())
+        snapshot['known_clients'] = list(_clients.clients())
+        snapshot['auto_assign'] = _auto_assign
+        snapshot['rescues'] = [num for num, r in _robots.items() if r.rescue]
+        if _game_running:
+            snapshot['game'] = {'game_id': str(_game_id), 'wall_base': _wall_base,
+                                'config': [_game_minutes, _game_sols, _short_trip, _long_trip]}
+    with _dispatch_lock:
+        snapshot['plans'] = {str(plan_id): dict(entry) for plan_id, entry in _in_flight.items()}
+        snapshot['next_plan_id'] = _last_plan_id + 1
+    return snapshot
+
+
+def _resume(saved):
+    global _game_minutes, _game_sols, _short_trip, _long_trip
+    global _game_running, _game_id, _sol_rt_base, _wall_base, _last_plan_id, _auto_assign
+    game = saved['game']
+    if game:
+        minutes = game['config'][0]
+        elapsed = (time.time() - game['wall_base']) * _clock_scale()  # game seconds since it started
+        if elapsed >= minutes * 60:
+            print(f'Game {game["game_id"]} in the journal ended while the host was down')
+            game = None
+
+    with _lock:
+        if saved['config']:
+            _game_minutes, _game_sols, _short_trip, _long_trip = saved['config']
+        now = _clock.now()
+        for client in saved['known_clients']:
+            _clients.add(client, now)
+        for client, number in saved['assignments'].items():
+            if number in _robots:
+                _clients.assign(client, number, now)
+        if saved['auto_assign'] is not None:
+            _auto_assign = saved['auto_assign']
+        if game:
+            _game_minutes, _game_sols, _short_trip, _long_trip = game['config']
+            _game_running = True
+            _game_id = uuid.UUID(game['game_id'])
+            _wall_base = game['wall_base']
+            _sol_rt_base = _clock.now() - elapsed
+            _set_game_timing()
+            for number in saved['rescues']:
+                if number in _robots:
+                    _robots[number].rescue = True
+        _publish_state()
+    with _dispatch_lock:
+        _last_plan_id = max(_last_plan_id, saved['next_plan_id'] - 1)
+    if not game:
+        return
+
+    state = _state
+    _schedule_game(state)
+    wall_now, now = time.time(), _clock.now()
+    for plan_id, entry in saved['plans'].items():
+        plan_id = int(plan_id)
+        payload = protocol.encode_plan(entry['plan'], plan_id) if entry['plan'] is not None else None
+        with _dispatch_lock:
+            _in_flight[plan_id] = entry
+        due = now + max(0.0, entry['due'] - wall_now) * _clock_scale()
+        _queue.schedule(due, _dispatch_plan, entry['robot'], payload, plan_id, entry['estimate'])
+    sol = get_sol()
+    print(f'Resumed game {_game_id} at sol {sol[0]:.1f} with {len(saved["plans"])} plans in flight')
+
+
+def on_shutdown(hook):
+    _shutdown_hooks.append(hook)
 
 
 def shutdown():
+    # Lets streaming clients finish before the servers close
+    _publish('shutdown', {})
+    for hook in _shutdown_hooks:
+        hook()
+    _queue.stop()
+    journal.stop()
     for r in _robots.values():
-        r.robot.close()
+        r.robot.shutdown()
 
 
 def get_game_config():
-    return _game_minutes, _game_sols, _short_trip, _long_trip
+    state = _state
+    return state.game_minutes, state.game_sols, state.short_trip, state.long_trip
 
 
 def set_game_config(minutes, sols, short_trip, long_trip):
-    global _game_minutes, _game_sols, _short_trip, _long_trip, _mins_per_sol, _delay_scale
-    _game_minutes = minutes
-    _game_sols = sols
-    _short_trip = short_trip
-    _long_trip = long_trip
+    global _game_minutes, _game_sols, _short_trip, _long_trip
+    with _lock:
+        _game_minutes = minutes
+        _game_sols = sols
+        _short_trip = short_trip
+        _long_trip = long_trip
+        _publish_state()
+    journal.record('config', config=[minutes, sols, short_trip, long_trip])
 
 
-def found_robot(name, ip):
+def found_robot(name, ip, port=None):
+    # Returns whether the robot is one of ours.  One the fleet does not know waits for the operator.
+    # One with a new hostname is found by the address it last advertised from.
     with _lock:
-        for rid in _robot_ids:
-            if rid['name'] == name:
-                _robots[rid['id']].robot.set_ip(ip)
-                break
+        number = _fleet.heard(name, ip)
+        robot = _robots.get(number)
+        offered = robot is None and _fleet.offer(name, ip, port, _clock.now())
+        if offered:
+            _publish_state()
+    if offered:
+        print(f'Robot {name} at {ip} is not in the fleet and is waiting to be added')
+    elif robot and robot.label != name:
+        print(f'Robot {name} at {ip} taken to be robot {number}, {robot.label}, last heard there')
+    # The robot connects on its own thread; never hold _lock across network I/O
+    if robot:
+        robot.robot.set_ip(ip, port)
+    return robot is not None
 
 
-def get_user_robot(clientId: str):
-    _client_pings[clientId] = time.time()
+def get_pending_robots():
+    # [(name, ip, seconds since first heard)] for robots waiting to be added to the fleet
+    now = _clock.now()
+    with _lock:
+        return [(name, ip, now - first_heard) for name, (ip, port, first_heard) in _fleet.pending().items()]
+
+
+def get_fleet():
+    # [(robot info, address last advertised from)] in number order
     with _lock:
-        if clientId in _client_robots:
-            robotId = _client_robots[clientId]
-            return robotId
+        return [(dict(rid), _fleet.ip_of(rid['id'])) for rid in _fleet.robots()]
+
 
-        # No robot assigned yet, enter the waitlist
-        if clientId not in _known_clients:
-            _known_clients.add(clientId)
+def find_robot(name=None, mac=None, ip=None):
+    # (robot info, address last advertised from) for the robot with that name, Bluetooth address or
+    # address, or None
+    with _lock:
+        number = _fleet.find(name, mac, ip)
+        if number is None:
             return None
+        return dict(_fleet.get(number)), _fleet.ip_of(number)
+
+
+def confirm_robot(name, number=None, btmac=None):
+    # Adds a robot that advertised itself to the fleet, as number or the next free one, and connects
+    # to it.  Returns (number, None), or (None, why not).
+    global _robots
+    with _lock:
+        try:
+            rid, ip, port = _fleet.confirm(name, number, btmac)
+        except (OSError, ValueError) as err:
+            return None, str(err)
+        robot = _Robot(rid)
+        _robots = {**_robots, rid['id']: robot}
+        _publish_state()
+    print(f'Robot {name} added to the fleet as robot {rid["id"]}')
+    _publish('fleet', {'robots': list(_state.robots)})
+    robot.robot.set_ip(ip, port)
+    return rid['id'], None
+
+
+def ignore_robot(name):
+    with _lock:
+        ignored = _fleet.ignore(name)
+        if ignored:
+            _publish_state()
+    return ignored
+
+
+def check_fleet():
+    # Reloads the fleet if its file has been edited; the engine runs this periodically.
+    # A file that does not load is retried every time, so a half-saved edit is picked up once finished.
+    with _lock:
+        changed = _fleet.changed()
+    if changed:
+        reload_fleet()
+
+
+def reload_fleet():
+    # Re-reads the fleet file.  New robots are added, renamed ones relabelled, and those no longer
+    # listed are disconnected and released.  Returns False if the file could not be used.
+    global _robots, _fleet_error
+    with _lock:
+        try:
+            added, removed, changed = _fleet.load()
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            if repr(err) != _fleet_error:
+                print(f'Fleet not reloaded: {repr(err)}')
+            _fleet_error = repr(err)
+            return False
+        _fleet_error = None
+        robots = dict(_robots)
+        for rid in added:
+            robots[rid['id']] = _Robot(rid)
+        for rid in changed:
+            robots[rid['id']].label = rid['name']
+            robots[rid['id']].robot.robot_mac_addr = rid['btmac']
+        retired = [robots.pop(num) for num in removed]
+        released = [(_clients.release_robot(num), num) for num in removed]
+        _robots = robots
+        _publish_state()
+    for r in retired:
+        r.robot.shutdown()
+    for client, number in released:
+        if client is not None:
+            journal.record('release', clientId=client)
+            _publish('release', {'clientId': client, 'robot_number': number})
+    if added or removed or changed:
+        print(f'Fleet reloaded: {len(added)} added, {len(removed)} removed, {len(changed)} changed')
+        _publish('fleet', {'robots': list(_state.robots)})
+    return True
+
+
+def get_user_robot(clientId: str):
+    state = _state
+    robotId = state.client_robots.get(clientId)
+    if robotId:
+        update_ping(clientId)
+        return robotId
+
+    # No robot assigned yet, enter the waitlist, or rejoin it after losing a robot
+    with _lock:
+        if clientId in _clients:
+            _clients.touch(clientId, _clock.now())
+            if _clients.join(clientId, _clock.now()):
+                _publish_state()
+            return None
+        evicted = _clients.add(clientId, _clock.now())
+        _publish_state()
+    journal.record('client', clientId=clientId)
+    _forget_clients(evicted)
     return None
 
-def get_known_clients() -> 'list[str]':
+
+def assign_waiting_clients():
+    # One pass of automatic assignment; the engine runs it every tick
+    state = _state
+    if not state.auto_assign or not state.waitlist:
+        return
+    now = _clock.now()
+    with _lock:
+        waiting = [client for client in _clients.waitlist() if now - _clients.last_seen(client) <= _stale_after]
+        free = [num for num in _robots if _clients.client_of(num) is None and _robots[num].robot.is_connected()]
+        # During a game, players who have gone quiet make way for those waiting, only as many as
+        # are waiting without a free robot, quietest first
+        reclaimed = []
+        if _game_running and len(waiting) > len(free):
+            quiet_since = {client: max(_clients.last_seen(client), _sol_rt_base)
+                           for client in _clients.client_robots()}
+            stale = sorted((since, client) for client, since in quiet_since.items()
+                           if now - since > _stale_after and get_connected(_clients.robot_of(client)))
+            for _, client in stale[:len(waiting) - len(free)]:
+                number = _clients.release_client(client)
+                reclaimed.append((client, number))
+                free.append(number)
+        # Clients that left the queue without saying so are skipped; idle eviction forgets them
+        assigned = [(client, number, _clients.assign(client, number, now)) for client, number in zip(waiting, free)]
+        if reclaimed or assigned:
+            _publish_state()
+    for client, number in reclaimed:
+        print(f'Robot {number} reclaimed from {client}, silent for over {_stale_after:.0f} s')
+        journal.record('release', clientId=client)
+        _publish('robot_reclaimed', {'clientId': client, 'robot_number': number})
+    for client, number, waited in assigned:
+        _assign_waits.append(waited)
+        journal.record('assign', clientId=client, robot=number)
+        _publish('assignment', {'clientId': client, 'robot_number': number, 'waited': waited})
+
+
+def _rotate_players():
+    # At the end of a game, the longest serving players make way for clients waiting for a robot
+    if not _auto_assign:
+        return
+    now = _clock.now()
+    with _lock:
+        waiting = sum(1 for client in _clients.waitlist() if now - _clients.last_seen(client) <= _stale_after)
+        players = sorted(_clients.client_robots(), key=_clients.assigned_at)[:waiting]
+        rotated = [(client, _clients.release_client(client)) for client in players]
+        if rotated:
+            _publish_state()
+    for client, number in rotated:
+        journal.record('release', clientId=client)
+        _publish('release', {'clientId': client, 'robot_number': number})
+    assign_waiting_clients()
+
+
+def set_auto_assign(enabled: bool):
+    global _auto_assign
     with _lock:
-        return list(_known_clients)
+        _auto_assign = enabled
+        _publish_state()
+    journal.record('auto_assign', enabled=enabled)
+
+
+def get_waitlist():
+    # [(clientId, seconds waiting)] in the order robots will be handed out
+    now = _clock.now()
+    return [(client, now - (_clients.joined(client) or now)) for client in _state.waitlist]
+
+
+def get_assignment_waits():
+    # (mean, max) seconds recent clients waited for a robot
+    waits = list(_assign_waits)
+    return (sum(waits) / len(waits) if waits else 0.0), max(waits, default=0.0)
+
+
+def evict_idle_clients():
+    # Forgets clients without a robot that have stopped calling; the engine runs this periodically
+    with _lock:
+        evicted = _clients.evict_idle(_clock.now())
+        if evicted:
+            _publish_state()
+    _forget_clients(evicted)
+
+
+def _forget_clients(evicted):
+    for clientId in evicted:
+        journal.record('client_evicted', clientId=clientId)
+        _publish('client_evicted', {'clientId': clientId})
+    if evicted:
+        print(f'Forgot {len(evicted)} clients')
+
+def get_known_clients() -> 'frozenset[str]':
+    return _state.known_clients
 
 def get_valid_robot_numbers():
-    nums = []
-    for num in _robots:
-        nums.append(num)
-    return nums
+    return list(_state.robots)
 
 
 def get_robot_label(number):
-    return _robots[number].label
+    robot = _robots.get(number)
+    return robot.label if robot else None
 
 
 def get_player_name(number):
-    robot = _robots[number]
-    if robot in _client_robots:
-        return _client_robots[robot]
-    else:
-        return None
+    return _state.robot_clients.get(number)
 
 
 def get_game_state():
-    return (_game_running, _game_id)
+    state = _state
+    return (state.game_running, state.game_id)
+
+
+def get_event_version():
+    return _event_version
+
+
+def wait_for_events(since: int, timeout: float):
+    # Waits up to timeout for events newer than since.
+    # Returns (current version, events, complete) where complete is False if events after
+    # since have already fallen out of the history and the client should re-read full state.
+    with _event_cond:
+        if since > _event_version:
+            since = 0  # client saw an earlier run of the host
+        _event_cond.wait_for(lambda: _event_version > since, timeout)
+        events = [e for e in _events if e[0] > since]
+        complete = not _events or _events[0][0] <= since + 1
+        return _event_version, events, complete
 
-def start_game():
-    global _sol_rt_base, _game_running, _queue, _mins_per_sol, _delay_scale
-    _sol_rt_base = time.time()
-    _game_running = True
-    _queue = []
 
+def _publish(name: str, data: dict):
+    global _event_version
+    with _event_cond:
+        _event_version += 1
+        _events.append((_event_version, name, data))
+        _event_cond.notify_all()
+
+
+def start_game():
+    global _sol_rt_base, _game_running, _wall_base
+    _queue.clear()
+    with _lock:
+        _sol_rt_base = _clock.now()
+        _wall_base = time.time()
+        _game_running = True
+        _set_game_timing()
+        _publish_state()
+    state = _state
+    journal.record('game_start', game_id=str(state.game_id), wall_base=_wall_base, time_scale=_clock_scale(),
+                   config=[state.game_minutes, state.game_sols, state.short_trip, state.long_trip])
+    _schedule_game(state)
+    _publish('game_start', {'game_id': str(state.game_id), 'total_sols': state.game_sols,
+                            'mins_per_sol': state.mins_per_sol})
+
+
+def _set_game_timing():
+    # Must be called holding _lock
+    global _mins_per_sol, _delay_scale
     _mins_per_sol = _game_minutes / _game_sols
     delay_range = _long_trip - _short_trip  # delay range in seconds
     # scale from game elapsed seconds to current light delay
     _delay_scale = float(delay_range) / float(_game_minutes * 60)
 
 
+def _schedule_game(state):
+    # Announce each new sol as it begins
+    now = _clock.now()
+    for sol in range(2, state.game_sols + 2):
+        due = state.sol_rt_base + (sol - 1) * state.secs_per_sol
+        if due > now:
+            _queue.schedule(due, _sol_tick, sol)
+    # The game ends once the last sol is over
+    _queue.schedule(state.sol_rt_base + state.game_sols * state.secs_per_sol, _end_game, state.game_id)
+
+
 def abort_game():
     global _game_running, _game_id
-    _game_running = False
-    _game_id = uuid.uuid1()
+    with _lock:
+        _game_running = False
+        ended = _game_id
+        _game_id = uuid.uuid1()
+        _publish_state()
+    _queue.clear()
+    _clear_dispatch()
+    journal.record('game_end', game_id=str(ended))
+    _publish('game_abort', {'game_id': str(ended)})
+
+
+def _sol_tick(sol):
+    state = _state
+    if state.game_running:
+        _publish('sol', {'sol': sol, 'total_sols': state.game_sols, 'mins_per_sol': state.mins_per_sol})
+
+
+def _end_game(game_id):
+    if _state.game_running and _state.game_id == game_id:
+        print('Game over')
+        abort_game()
+        _rotate_players()
 
 
 def is_game_running():
-    return _game_running
+    return _state.game_running
 
 
 def get_sol():
-    if _game_running:
+    state = _state
+    if state.game_running:
         # Update the Sol timer
-        mins = (time.time() - _sol_rt_base) / 60.0
-        sol_now = 1 + mins / _mins_per_sol
-        return sol_now, _game_sols, _mins_per_sol
+        sol_now = 1 + (_clock.now() - state.sol_rt_base) / state.secs_per_sol
+        return sol_now, state.game_sols, state.mins_per_sol
     return None
 
 
-def get_light_delay():
+def get_light_delay(state: GameState = None):
     # Calculate the roundtrip light time from Earth to Mars
-    secs = time.time() - _sol_rt_base  # game time in seconds
-    return secs * _delay_scale + _short_trip
+    state = state or _state
+    secs = _clock.now() - state.sol_rt_base  # game time in seconds
+    return secs * state.delay_scale + state.short_trip
 
 
 def get_connected(number):
@@ -174,12 +679,31 @@ def get_connected(number):
     return robot.robot.is_connected() if robot else False
 
 
+def get_link_stats(number):
+    # (outbound queue depth, last send ms, mean send ms, dropped commands, last connect ms)
+    robot = _robots.get(number)
+    return robot.robot.get_link_stats() if robot else (0, 0.0, 0.0, 0, 0.0)
+
+
+def get_link_health(number):
+    # ('down' | 'ok' | 'degraded', heartbeat RTT ms, jitter ms, seconds since the robot was last heard)
+    robot = _robots.get(number)
+    return robot.robot.get_link_health() if robot else ('down', 0.0, 0.0, 0.0)
+
+
 def reconnect(number):
     robot = _robots.get(number)
     if robot:
         robot.robot.connect()
 
 
+def reconnect_all():
+    # Each robot connects on its own worker, so the whole fleet comes back in parallel
+    for r in _robots.values():
+        if not r.robot.is_connected():
+            r.robot.connect()
+
+
 def disconnect(number):
     robot = _robots.get(number)
     if robot:
@@ -187,13 +711,13 @@ def disconnect(number):
 
 
 def ping_robots():
+    # Heartbeats; robots answer each one so the links can measure their round trip time
     for r in _robots.values():
         r.robot.send_command('ping')
 
 
 def get_rescue(number):
-    robot = _robots.get(number)
-    return robot.rescue if robot else False
+    return number in _state.rescues
 
 
 def set_rescue(number):
@@ -201,6 +725,9 @@ def set_rescue(number):
     if robot:
         with _lock:
             robot.rescue = True
+            _publish_state()
+        journal.record('rescue', robot=number)
+        _publish('rescue', {'robot_number': number})
 
 
 def clear_rescue(number):
@@ -208,99 +735,237 @@ def clear_rescue(number):
     if robot:
         with _lock:
             robot.rescue = False
+            _publish_state()
+        journal.record('rescue_cleared', robot=number)
+        _publish('rescue_cleared', {'robot_number': number})
 
 
 def assign_robot(robotId: str, clientId: str):
     robot = _robots.get(robotId)
     if robot:
         with _lock:
-            if robot.taken:
+            if _clients.client_of(robotId) is not None:
                 print(f"Cannot assign robot {robotId} as it is already assigned")
                 return
-            if clientId in _client_robots:
+            if _clients.robot_of(clientId) is not None:
                 print(f"Cannot assign robot to client {clientId} as a robot is already assigned to this client")
                 return
-            robot.taken = True
-            robot.client = clientId
-            _client_robots[clientId] = robotId
+            waited = _clients.assign(clientId, robotId, _clock.now())
+            _publish_state()
+        _assign_waits.append(waited)
+        journal.record('assign', clientId=clientId, robot=robotId)
+        _publish('assignment', {'clientId': clientId, 'robot_number': robotId, 'waited': waited})
 
 def release_robot_from_client(client):
-    robotId = _client_robots.get(client)
-    if robotId:
-        with _lock:
-            del _client_robots[client]
-            robot = _robots[robotId]
-            robot.taken = False
-            robot.client = None
+    with _lock:
+        robotId = _clients.release_client(client)
+        if robotId is None:
+            return
+        _publish_state()
+    journal.record('release', clientId=client)
+    _publish('release', {'clientId': client, 'robot_number': robotId})
 
 def release_robot(number):
-    robot = _robots.get(number)
-    if robot:
-        with _lock:
-            del _client_robots[robot.client]
-            robot.taken = False
-            robot.client = None
+    with _lock:
+        client = _clients.release_robot(number)
+        if client is None:
+            return
+        _publish_state()
+    journal.record('release', clientId=client)
+    _publish('release', {'clientId': client, 'robot_number': number})
 
 def release_all_robots():
     with _lock:
-        rids = list(_client_robots.values())
-        for rid in rids:
-            robot = _robots.get(rid)
-            if not robot:
-                continue
-            del _client_robots[robot.client]
-            robot.taken = False
-            robot.client = None
+        released = _clients.release_all()
+        _publish_state()
+    for client, rid in released:
+        journal.record('release', clientId=client)
+        _publish('release', {'clientId': client, 'robot_number': rid})
 
 def get_taken(number):
-    robot = _robots.get(number)
-    if robot:
-        with _lock:
-            return robot.taken
-    return False
+    return number in _state.robot_clients
 
 def get_last_client_ping(clientId):
-    if clientId in _client_pings:
-        return time.time() - _client_pings[clientId]
-    else:
-        return None
+    seen = _clients.last_seen(clientId)
+    return _clock.now() - seen if seen is not None else None
 
 def queue_plan(number, plan):
-    global _queue
-    if _game_running:
-        delay = get_light_delay()
-        due = time.time() + delay
-        with _lock:
-            _queue.append((due, number, plan))
-        return delay
-    return 0
+    # plan is the planner's JSON, or None for a rescue.  It is checked and encoded for the
+    # robot here, once; raises ValueError if the robot could not run it.
+    # Returns (light delay, plan id); rescues get an id too.
+    with _queue_plan_time.time():
+        return _queue_plan(number, plan)
+
+
+def _queue_plan(number, plan):
+    global _last_plan_id
+    state = _state
+    client = state.robot_clients.get(number)
+    if client:
+        update_ping(client)  # a player sending plans is still there, whatever their browser polls
+    if not state.game_running:
+        return 0, 0  # nowhere to send it, so no id to spend and nothing to encode
+    with _dispatch_lock:
+        _last_plan_id += 1
+        plan_id = _last_plan_id
+    payload = protocol.encode_plan(plan, plan_id) if plan is not None else None
+    delay = get_light_delay(state)
+    estimate = _estimate_run_time(payload) if payload else 0.0
+    entry = {'robot': number, 'plan': plan, 'due': time.time() + delay / _clock_scale(), 'estimate': estimate}
+    with _dispatch_lock:
+        _in_flight[plan_id] = entry
+    journal.record('plan', plan_id=plan_id, **entry)
+    _queue.schedule(_clock.now() + delay, _dispatch_plan, number, payload, plan_id, estimate)
+    _plans_queued.inc('plan' if payload else 'rescue')
+    return delay, plan_id
+
+
+def _estimate_run_time(payload):
+    return robot_model.plan_duration(robot_model.compile_plan(protocol.decode_plan(payload)[1]))
 
 def update_ping(clientId):
-    _client_pings[clientId] = time.time()
+    # Lock free, like the other readers; see ClientRegistry.touch
+    _clients.touch(clientId, _clock.now())
+
+def get_dispatch_lateness():
+    # (dispatch count, last, max, mean) lateness in seconds of recent plan dispatches
+    return _queue.get_lateness()
 
-def process_queue():
-    global _queue
-    if not _game_running:
+
+def _dispatch_plan(number, plan, plan_id, estimate):
+    # Runs on the scheduler thread when a plan or rescue comes due
+    with _dispatch_lock:
+        _in_flight.pop(plan_id, None)
+    journal.record('dispatch', plan_id=plan_id)
+    if not _state.game_running:
         return
+    late = _queue.get_lateness()[1]
+    if plan is None:
+        # Rescues never wait behind the robot's held plans
+        print(f'Rescue for robot {number} arrived {late * 1000:.1f} ms late')
+        set_rescue(number)
+    else:
+        print(f'Plan {plan_id} for robot {number} dispatched {late * 1000:.1f} ms late')
+        _hold_plan(number, plan, plan_id, estimate)
 
-    now = time.time()
-    q = []
-    with _lock:
-        while len(_queue) > 0 and _queue[0][0] <= now:
-            q.append(_queue.pop(0))
 
-    # We have quickly moved the due elements from the global queue to the local one
-    # Now we can execute the plan while not holding the lock
-    for e in q:
-        number = e[1]
-        plan = e[2]
-        if plan is None:
-            set_rescue(number)
-        else:
-            _send_plan(number, plan)
+def _hold_plan(number, plan, plan_id, estimate):
+    robot = _robots.get(number)
+    if not robot:
+        return
+    dropped = None
+    with _dispatch_lock:
+        if len(robot.held) >= _max_held:
+            dropped = robot.held.popleft()[0]
+            robot.held_dropped += 1
+        robot.held.append((plan_id, plan, estimate, _clock.now()))
+    if dropped is not None:
+        print(f'Robot {number} has too many plans waiting, dropped plan {dropped}')
+        _publish('plan_dropped', {'robot_number': number, 'plan_id': dropped})
+    _release_held(number)
+
+
+def _release_held(number):
+    # Sends the robot its next held plan if it is free.  Called when a plan is held, when the
+    # robot reports a plan finished, and when a running plan's estimated finish time passes.
+    robot = _robots.get(number)
+    if not robot:
+        return
+    with _dispatch_lock:
+        now = _clock.now()
+        if not robot.held or (robot.running and now < robot.busy_until):
+            return
+        if not _state.game_running:
+            robot.held.clear()
+            return
+        robot.running.clear()  # anything still running is overdue and presumed finished
+        plan_id, plan, estimate, held_at = robot.held.popleft()
+        robot.running.add(plan_id)
+        robot.busy_until = now + estimate + _busy_margin
+        robot.waits.append(now - held_at)
+        busy_until = robot.busy_until
+    _queue.schedule(busy_until, _release_held, number)
+    if not _send_plan(number, plan, plan_id):
+        with _dispatch_lock:
+            robot.running.discard(plan_id)
+
+
+def _plan_finished(number, plan_id):
+    robot = _robots.get(number)
+    with _dispatch_lock:
+        robot.running.discard(plan_id)
+    _release_held(number)
 
 
-def _send_plan(number, plan):
+def get_dispatch_queue(number):
+    # (plans held, robot busy, mean wait s, max wait s, plans dropped) for a robot's dispatch queue
     robot = _robots.get(number)
-    if robot:
-        robot.robot.send_command(plan)
+    if not robot:
+        return 0, False, 0.0, 0.0, 0
+    with _dispatch_lock:
+        busy = bool(robot.running) and _clock.now() < robot.busy_until
+        waits = list(robot.waits)
+        return (len(robot.held), busy, sum(waits) / len(waits) if waits else 0.0, max(waits, default=0.0),
+                robot.held_dropped)
+
+
+def _clear_dispatch():
+    with _dispatch_lock:
+        _in_flight.clear()
+        for r in _robots.values():
+            r.held.clear()
+            r.running.clear()
+
+
+def _send_plan(number, plan, plan_id):
+    with _send_plan_time.time():
+        sent = _hand_to_link(number, plan, plan_id)
+    _plans_sent.inc('ok' if sent else 'failed')
+    return sent
+
+
+def _hand_to_link(number, plan, plan_id):
+    robot = _robots.get(number)
+    if not robot:
+        return False
+    robot.sent_plans[plan_id] = time.monotonic()
+    if len(robot.sent_plans) > _sent_plans_size:
+        del robot.sent_plans[next(iter(robot.sent_plans))]
+    if not robot.robot.send_command(plan):
+        print(f'Plan {plan_id} for robot {number} could not be queued for sending')
+        return False
+    return True
+
+
+def get_robot_telemetry(number) -> RobotTelemetry:
+    robot = _robots.get(number)
+    return robot.telemetry if robot else _no_telemetry
+
+
+def _on_telemetry(number, t):
+    # Runs on the robot's reader thread, the only writer of its telemetry
+    robot = _robots.get(number)
+    if robot is None:
+        return
+    telemetry = robot.telemetry._replace(last_heard=time.monotonic(), left=t.left, right=t.right)
+    if t.kind == protocol.TM_STATUS:
+        telemetry = telemetry._replace(battery=t.battery)
+    elif t.kind == protocol.TM_ACCEPTED:
+        sent = robot.sent_plans.pop(t.plan_id, None)
+        latency = telemetry.last_heard - sent if sent is not None else None
+        robot.plan_started = t.robot_time
+        telemetry = telemetry._replace(plan_id=t.plan_id, step=0, steps=t.step, latency=latency, error='')
+        _publish('plan_accepted', {'robot_number': number, 'plan_id': t.plan_id, 'steps': t.step})
+    elif t.kind == protocol.TM_STEP_START:
+        telemetry = telemetry._replace(plan_id=t.plan_id, step=t.step + 1)
+    elif t.kind == protocol.TM_DONE:
+        run_time = t.robot_time - robot.plan_started
+        telemetry = telemetry._replace(plan_id=0, step=0, steps=0, run_time=run_time)
+        _publish('plan_done', {'robot_number': number, 'plan_id': t.plan_id, 'run_time': run_time})
+    elif t.kind == protocol.TM_ERROR:
+        print(f'Robot {number} reports an error in plan {t.plan_id}: {t.message}')
+        telemetry = telemetry._replace(error=t.message)
+        _publish('robot_error', {'robot_number': number, 'plan_id': t.plan_id, 'message': t.message})
+    robot.telemetry = telemetry
+    if t.kind in (protocol.TM_DONE, protocol.TM_ERROR):
+        _plan_finished(number, t.plan_id)
@@ -0,0 +1,63 @@
+import threading
+import core
+
+# The game engine's periodic work, independent of any display.
+# Plans and the end of the game are driven by core's scheduler; the engine keeps the
+# robot links alive, hands robots to waiting clients, sounds the klaxon while a rescue is
+# waiting, forgets idle clients and picks up edits to the fleet file.
+
+_tick = 0.5  # seconds between engine passes
+_evict_every = 60  # engine passes between sweeps for idle clients
+_fleet_every = 10  # engine passes between checks of the fleet file
+_engine_thread = None
+_stop = threading.Event()
+_alert = None
+
+
+def _load_alert():
+    # The klaxon is optional so the engine can run on a server without audio
+    try:
+        import sound
+        return sound.alert
+    except Exception as err:
+        print(f'Klaxon unavailable: {repr(err)}')
+        return None
+
+
+def _run():
+    flash = False
+    passes = 0
+    while not _stop.wait(_tick):
+        # Keep robots alive
+        core.ping_robots()
+
+        # Hand free robots to waiting clients
+        core.assign_waiting_clients()
+
+        passes += 1
+        if passes % _evict_every == 0:
+            core.evict_idle_clients()
+        if passes % _fleet_every == 0:
+            core.check_fleet()
+
+        # Sound the klaxon every other pass while any rescue is waiting
+        flash = not flash
+        if flash and _alert and core.get_state().rescues:
+            _alert()
+
+
+def start(alerts=True):
+    global _engine_thread, _alert
+    _alert = _load_alert() if alerts else None
+    _stop.clear()
+    _engine_thread = threading.Thread(target=_run, name='engine', daemon=True)
+    _engine_thread.start()
+    core.on_shutdown(stop)
+
+
+def stop():
+    global _engine_thread
+    _stop.set()
+    if _engine_thread is not None:
+        _engine_thread.join()
+        _engine_thread = None
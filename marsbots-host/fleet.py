@@ -0,0 +1,177 @@
+import json
+import os
+
+# The robots the host runs, read from a fleet file so robots can be added, renumbered or relabelled
+# without touching the code:
+#   {"robots": [{"id": 1, "name": "ev3dev-ssci-25", "btmac": "00:17:E9:B3:E3:57"}, ...]}
+#  id - Robot Number is the highly legible flag on the robot
+#  name - Sticker label on the EV3, and the hostname it advertises
+#  btmac - Mac address of the EV3's bluetooth, null for a robot only reached over IP
+# Robots are indexed by number, name, Bluetooth address and the address each last advertised from,
+# so handling an advertisement or looking a robot up costs the same however large the fleet.  A
+# robot advertising under a name the fleet does not know, from the address a robot in the fleet last
+# used, is taken to be that robot with a new hostname.  Any other robot that advertises without
+# being in the fleet waits in a pending list until the operator adds it, which also writes it to
+# the file.
+#
+# Not thread safe on its own: core makes every call holding its _lock.
+
+_fleet_path = os.environ.get('MARSBOTS_FLEET',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet.json'))
+_max_pending = 50
+
+# An arena worker runs only its own robots, listed by number in MARSBOTS_ROBOTS
+_arena_robots = ({int(num) for num in os.environ['MARSBOTS_ROBOTS'].split(',')}
+                 if os.environ.get('MARSBOTS_ROBOTS') else None)
+
+
+def _mac(addr):
+    return addr.upper() if addr else None
+
+
+def _read(path):
+    # (robots as listed, file mtime); an absent file is an empty fleet
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return [], None
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    robots = [{'id': int(entry['id']), 'name': entry['name'], 'btmac': _mac(entry.get('btmac'))}
+              for entry in config['robots']]
+    for key in ('id', 'name', 'btmac'):
+        values = [rid[key] for rid in robots if rid[key] is not None]
+        if len(values) != len(set(values)):
+            raise ValueError(f'Two robots in {path} have the same {key}')
+    return robots, mtime
+
+
+class Fleet:
+    def __init__(self, path=_fleet_path, numbers=_arena_robots):
+        self.path = path
+        self.numbers = numbers  # robot numbers this host runs, None for the whole fleet
+        self._mtime = None
+        self._by_number: 'dict[int, dict]' = {}
+        self._by_name: 'dict[str, int]' = {}
+        self._by_mac: 'dict[str, int]' = {}
+        self._by_ip: 'dict[str, int]' = {}  # address last advertised from -> robot number
+        self._ips: 'dict[int, str]' = {}  # and back
+        self._elsewhere: 'set[str]' = set()  # robots in the file that another arena runs
+        self._pending: 'dict[str, tuple]' = {}  # name -> (ip, port, time first heard), oldest first
+        self._ignored: 'set[str]' = set()
+
+    def robots(self):
+        # Robot info dicts in number order
+        return [self._by_number[num] for num in sorted(self._by_number)]
+
+    def get(self, number):
+        return self._by_number.get(number)
+
+    def find(self, name=None, mac=None, ip=None):
+        # The number of the robot with any of the given name, Bluetooth address or last address
+        for number in (self._by_name.get(name), self._by_mac.get(_mac(mac)), self._by_ip.get(ip)):
+            if number is not None:
+                return number
+        return None
+
+    def ip_of(self, number):
+        return self._ips.get(number)
+
+    def pending(self):
+        return self._pending
+
+    def load(self):
+        # Reads the file, returning ([robots added], [robot numbers removed], [robots renamed or re-addressed])
+        # against what was loaded before.  Raises if the file cannot be used, leaving the fleet as it was.
+        listed, mtime = _read(self.path)
+        if mtime is None:
+            print(f'No fleet file at {self.path}; robots that advertise will wait to be added')
+        robots = {rid['id']: rid for rid in listed if self.numbers is None or rid['id'] in self.numbers}
+        added = [rid for num, rid in robots.items() if num not in self._by_number]
+        removed = [num for num in self._by_number if num not in robots]
+        changed = [rid for num, rid in robots.items() if num in self._by_number and rid != self._by_number[num]]
+
+        self._mtime = mtime
+        self._by_number = robots
+        self._by_name = {rid['name']: num for num, rid in robots.items()}
+        self._by_mac = {rid['btmac']: num for num, rid in robots.items() if rid['btmac']}
+        self._elsewhere = {rid['name'] for rid in listed} - self._by_name.keys()
+        for num in removed:
+            self._by_ip.pop(self._ips.pop(num, None), None)
+        for name in self._by_name:
+            self._pending.pop(name, None)
+        return added, removed, changed
+
+    def changed(self):
+        # Whether the file has been edited since it was last loaded.  A file that failed to load
+        # still counts as changed, so it is tried again until it loads.
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        return mtime != self._mtime
+
+    def heard(self, name, ip):
+        # Records where a robot in the fleet advertised from, returning its number, or None if it is not ours
+        number = self._by_name.get(name)
+        if number is None:
+            return self._by_ip.get(ip)
+        self._set_ip(number, ip)
+        return number
+
+    def offer(self, name, ip, port, now):
+        # Queues a robot outside the fleet for the operator to add; True if it was not already waiting.
+        # Only a host running the whole fleet can take on robots it has never seen.
+        if self.numbers is not None or name in self._elsewhere or name in self._ignored:
+            return False
+        first_heard = self._pending.pop(name, (None, None, None))[2]
+        self._pending[name] = (ip, port, first_heard if first_heard is not None else now)
+        if len(self._pending) > _max_pending:
+            del self._pending[next(iter(self._pending))]
+        return first_heard is None
+
+    def confirm(self, name, number=None, btmac=None):
+        # Adds a pending robot as number, or the next free number, and writes it to the file.
+        # Returns (robot info, ip, port); raises ValueError if it cannot be added.
+        if name not in self._pending:
+            raise ValueError(f'No robot called {name} is waiting to join the fleet')
+        listed, _ = _read(self.path)
+        taken = {rid['id'] for rid in listed} | self._by_number.keys()
+        if number is None:
+            number = max(taken, default=0) + 1
+        elif number in taken:
+            raise ValueError(f'There is already a robot {number}')
+        btmac = _mac(btmac)
+        if btmac and (btmac in self._by_mac or btmac in {rid['btmac'] for rid in listed}):
+            raise ValueError(f'There is already a robot with Bluetooth address {btmac}')
+        rid = {'id': number, 'name': name, 'btmac': btmac}
+        self._save(listed + [rid])
+        ip, port, _ = self._pending.pop(name)
+        self._by_number[number] = rid
+        self._by_name[name] = number
+        if btmac:
+            self._by_mac[btmac] = number
+        self._set_ip(number, ip)
+        return rid, ip, port
+
+    def ignore(self, name):
+        # Stops offering a pending robot until the host restarts; False if it was not pending
+        self._ignored.add(name)
+        return self._pending.pop(name, None) is not None
+
+    def _set_ip(self, number, ip):
+        # A robot's address moves with it, and an address now in use is no longer any other robot's
+        old_ip = self._ips.get(number)
+        if old_ip == ip:
+            return
+        self._by_ip.pop(old_ip, None)
+        self._ips.pop(self._by_ip.get(ip), None)
+        self._ips[number] = ip
+        self._by_ip[ip] = number
+
+    def _save(self, robots):
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'robots': sorted(robots, key=lambda rid: rid['id'])}, f, indent=2)
+        os.replace(temp, self.path)
+        self._mtime = os.stat(self.path).st_mtime
@@ -0,0 +1,67 @@
+import os
+import threading
+from waitress import wasyncore
+from waitress.server import create_server
+
+# Serving limits, overridable from the environment for large events
+#  threads - worker pool size
+#  connections - simultaneous sockets before new connections are refused
+#  idle timeout - seconds a keep-alive connection may sit idle or a request may stall
+#  push slots - long-polls and event streams open at once, see PushLimit
+_threads = int(os.environ.get('MARSBOTS_HTTP_THREADS', 64))
+_connection_limit = int(os.environ.get('MARSBOTS_HTTP_CONNECTIONS', 1000))
+_idle_timeout = int(os.environ.get('MARSBOTS_HTTP_TIMEOUT', 60))
+_push_slots = int(os.environ.get('MARSBOTS_HTTP_PUSH_SLOTS', max(1, _threads // 4)))
+_max_body = 64 * 1024  # a plan is a few hundred bytes
+
+
+# A long-poll or event stream holds a worker for as long as it stays open, so a room of them
+# could take the whole pool and starve plans and sol polls.  Only so many are let in at once,
+# well below the pool size; the rest are refused and can fall back to plain polling.
+class PushLimit:
+    def __init__(self, slots=_push_slots):
+        self.slots = slots
+        self._free = threading.BoundedSemaphore(slots)
+
+    def acquire(self):
+        # True if a slot was free; never waits
+        return self._free.acquire(False)
+
+    def release(self):
+        self._free.release()
+
+
+# A pooled, keep-alive WSGI server that runs on its own thread and can be stopped cleanly
+class HttpServer:
+    def __init__(self, app, host, port, threads=_threads):
+        self._server = create_server(
+            app, host=host, port=port,
+            threads=threads,
+            connection_limit=_connection_limit,
+            channel_timeout=_idle_timeout,
+            cleanup_interval=min(30, _idle_timeout),
+            max_request_body_size=_max_body,
+            ident='Marsbots')
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.effective_port
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        print(f'Serving HTTP on port {self.port} with {self._server.adj.threads} workers')
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        # Close every socket from inside the server's own loop, which then exits.
+        # The loop may run the close before our wake-up write lands, closing the trigger under us.
+        try:
+            self._server.trigger.pull_trigger(lambda: wasyncore.close_all(self._server._map))
+        except OSError:
+            pass
+        self._thread.join(timeout)
+        self._server.task_dispatcher.shutdown(timeout=timeout)
+        self._thread = None
@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+import time
+
+# Append-only game journal, so an interrupted event can pick up where it left off.
+#
+# core records every change to the game as a small JSON object, one per line in journal.jsonl.
+# Records are buffered in memory and written by a background thread, which fsyncs once per
+# batch, so recording never waits on the disk.  Every so often the writer asks core for a
+# compact snapshot of the whole game, saves it to snapshot.json (written to a temporary file
+# and renamed into place, so a crash leaves either the old snapshot or the new one) and moves
+# the journal records the snapshot covers to history.jsonl, which is kept for replay.py and
+# never read at startup.
+#
+# Applying a record is idempotent, so records that overlap a snapshot are harmless.
+# Times are wall-clock seconds, the only clock that survives a restart.
+
+_journal_dir = os.environ.get('MARSBOTS_JOURNAL_DIR', 'journal')
+_flush_interval = 0.2  # seconds between batched writes
+_snapshot_interval = 30.0  # seconds between snapshots
+
+_journal_name = 'journal.jsonl'
+_snapshot_name = 'snapshot.json'
+_history_name = 'history.jsonl'
+
+_cond = threading.Condition()
+_pending: 'list[dict]' = []
+_seq = 0
+_snapshot_fn = None
+_writer_thread = None
+_running = False
+
+
+def empty_state():
+    # The game state a journal describes, as load() returns it and core's snapshot provides it
+    return {
+        'seq': 0,
+        'config': None,  # [minutes, sols, short trip, long trip]
+        'game': None,  # {'game_id', 'wall_base', 'config'} while a game is running
+        'assignments': {},  # clientId -> robot number
+        'known_clients': [],
+        'rescues': [],  # robot numbers
+        'plans': {},  # plan id -> {'robot', 'plan', 'due', 'estimate'}, queued and not yet due
+        'next_plan_id': 1,
+        'auto_assign': None,  # None in journals from before it was recorded
+    }
+
+
+def _apply(state, record):
+    kind = record['kind']
+    if kind == 'config':
+        state['config'] = record['config']
+    elif kind == 'game_start':
+        state['game'] = {'game_id': record['game_id'], 'wall_base': record['wall_base'],
+                         'config': record['config']}
+        state['plans'] = {}
+    elif kind == 'game_end':
+        state['game'] = None
+        state['plans'] = {}
+        state['rescues'] = []
+    elif kind == 'client':
+        if record['clientId'] not in state['known_clients']:
+            state['known_clients'].append(record['clientId'])
+    elif kind == 'client_evicted':
+        if record['clientId'] in state['known_clients']:
+            state['known_clients'].remove(record['clientId'])
+    elif kind == 'assign':
+        state['assignments'][record['clientId']] = record['robot']
+    elif kind == 'release':
+        state['assignments'].pop(record['clientId'], None)
+    elif kind == 'rescue':
+        if record['robot'] not in state['rescues']:
+            state['rescues'].append(record['robot'])
+    elif kind == 'rescue_cleared':
+        if record['robot'] in state['rescues']:
+            state['rescues'].remove(record['robot'])
+    elif kind == 'plan':
+        state['plans'][str(record['plan_id'])] = {'robot': record['robot'], 'plan': record['plan'],
+                                                  'due': record['due'], 'estimate': record['estimate']}
+        state['next_plan_id'] = max(state['next_plan_id'], record['plan_id'] + 1)
+    elif kind == 'auto_assign':
+        state['auto_assign'] = record['enabled']
+    elif kind == 'dispatch':
+        state['plans'].pop(str(record['plan_id']), None)
+    state['seq'] = max(state['seq'], record['seq'])
+
+
+def record(kind: str, **data):
+    # Queues a record for the writer; never blocks on I/O.  Does nothing unless the journal is running.
+    global _seq
+    with _cond:
+        if not _running:
+            return
+        _seq += 1
+        data.update(seq=_seq, t=time.time(), kind=kind)
+        _pending.append(data)
+
+
+def get_seq():
+    return _seq
+
+
+def _path(name):
+    return os.path.join(_journal_dir, name)
+
+
+def read_records(path=None):
+    # Every readable record in a journal file, in order.  A torn last line from a crash is skipped.
+    records = []
+    try:
+        with open(path or _path(_journal_name), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def read_all(journal_dir=None):
+    # The full record of every game: the history followed by the live journal
+    journal_dir = journal_dir or _journal_dir
+    by_seq = {}
+    for name in (_history_name, _journal_name):
+        for rec in read_records(os.path.join(journal_dir, name)):
+            by_seq.setdefault(rec['seq'], rec)  # a crash mid-compaction can leave a record in both
+    return [by_seq[seq] for seq in sorted(by_seq)]
+
+
+def load():
+    # Rebuilds the game state from the last snapshot and the journal written since
+    global _seq
+    state = empty_state()
+    try:
+        with open(_path(_snapshot_name), encoding='utf-8') as f:
+            state.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except ValueError as err:
+        print(f'Ignoring unreadable journal snapshot: {repr(err)}')
+    for rec in read_records():
+        if rec['seq'] > state['seq']:
+            _apply(state, rec)
+    with _cond:
+        _seq = max(_seq, state['seq'])
+    return state
+
+
+def _write_snapshot(snapshot):
+    tmp = _path(_snapshot_name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _path(_snapshot_name))
+
+
+def _compact(journal, covered_seq):
+    # Moves the records a snapshot now covers to the history.  Returns the new journal handle.
+    journal.close()
+    records = read_records()
+    keep = [rec for rec in records if rec['seq'] > covered_seq]
+    with open(_path(_history_name), 'a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(rec) + '\n' for rec in records if rec['seq'] <= covered_seq))
+        f.flush()
+        os.fsync(f.fileno())
+    tmp = _path(_journal_name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for rec in keep:
+            f.write(json.dumps(rec) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _path(_journal_name))
+    return open(_path(_journal_name), 'a', encoding='utf-8')
+
+
+def _run():
+    journal = open(_path(_journal_name), 'a', encoding='utf-8')
+    next_snapshot = time.monotonic() + _snapshot_interval
+    while True:
+        with _cond:
+            _cond.wait(_flush_interval)
+            batch = _pending[:]
+            del _pending[:]
+            running = _running
+        if batch:
+            journal.write(''.join(json.dumps(rec) + '\n' for rec in batch))
+            journal.flush()
+            os.fsync(journal.fileno())
+        if not running:
+            journal.close()
+            return
+        if _snapshot_fn and time.monotonic() >= next_snapshot:
+            next_snapshot = time.monotonic() + _snapshot_interval
+            try:
+                snapshot = _snapshot_fn()
+                _write_snapshot(snapshot)
+                # Records made while the snapshot was taken are still pending and get written
+                # after it, so compacting only ever drops what the snapshot already holds
+                journal = _compact(journal, snapshot['seq'])
+            except OSError as err:
+                print(f'Journal snapshot failed: {repr(err)}')
+
+
+def start(snapshot_fn):
+    # snapshot_fn returns the whole game as empty_state() lays it out, with 'seq' set to
+    # get_seq() as read before the state was gathered
+    global _writer_thread, _snapshot_fn, _running
+    os.makedirs(_journal_dir, exist_ok=True)
+    _snapshot_fn = snapshot_fn
+    _running = True
+    _writer_thread = threading.Thread(target=_run, name='journal', daemon=True)
+    _writer_thread.start()
+
+
+def stop():
+    # Writes out everything recorded so far
+    global _writer_thread, _running
+    if _writer_thread is None:
+        return
+    with _cond:
+        _running = False
+        _cond.notify()
+    _writer_thread.join()
+    _writer_thread = None
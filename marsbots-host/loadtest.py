@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+# Load test for the participant API.
+# Starts the host in-process against mock robots, then drives simulated participants that
+# follow the replit client's call pattern:
+#   welcome.py - poll /api/robot_assignment every second until a robot is assigned,
+#                then poll /api/sol every 500 ms until the game starts
+#   planner.py - read /api/sol, spend a while planning, post the plan to /api/plan,
+#                then wait out the transmission animation
+# Participants without a robot keep polling for one, as they do at a busy event, and core's
+# automatic assignment hands robots out as it would at the event.
+os.environ['MOCK_ROBOT'] = '1'
+
+import requests
+import clock
+import core
+import api_host
+import engine
+import protocol
+import mock_robot
+from mock_robot import MockRobot
+
+parser = argparse.ArgumentParser(description='Simulate a room of Marsbot participants against api_host')
+parser.add_argument('--clients', type=int, default=100, help='simulated participants')
+parser.add_argument('--duration', type=float, default=60, help='seconds of game play to measure')
+parser.add_argument('--plan-time', type=float, default=10, help='mean seconds a participant spends planning')
+parser.add_argument('--minutes', type=int, default=30, help='game length in minutes')
+parser.add_argument('--sols', type=int, default=10)
+parser.add_argument('--short-trip', type=int, default=5, help='light delay at game start, seconds')
+parser.add_argument('--long-trip', type=int, default=20, help='light delay at game end, seconds')
+parser.add_argument('--port', type=int, default=5099)
+parser.add_argument('--time-scale', type=float, default=1.0,
+                    help='run the game clock this many times faster than real time')
+parser.add_argument('--send-client-id', action='store_true',
+                    help='pass clientId to /api/sol and /api/plan, which the replit client does not')
+args = parser.parse_args()
+
+_base = f'http://127.0.0.1:{args.port}/api'
+_stop = threading.Event()
+_stats_lock = threading.Lock()
+_latencies: 'dict[str, list[float]]' = defaultdict(list)
+_errors: 'dict[str, int]' = defaultdict(int)
+
+# Game-clock due times of plans posted but not yet received, by plan id
+_expected: 'dict[int, float]' = {}
+_dispatch_lateness: 'list[float]' = []
+
+
+# A mock robot that records when each plan reaches it before running it
+class _TimedMockRobot(MockRobot):
+    def send_command(self, command):
+        if self.s is None:
+            return False
+        if command != 'ping':
+            now = core.now()
+            plan_id = protocol.decode_plan(command)[0]
+            with _stats_lock:
+                due = _expected.pop(plan_id, None)
+                if due is not None:
+                    _dispatch_lateness.append(now - due)
+        return super().send_command(command)
+
+
+def _call(session, method, endpoint, **kwargs):
+    start = time.perf_counter()
+    try:
+        resp = session.request(method, f'{_base}/{endpoint}', timeout=10, **kwargs)
+        resp.raise_for_status()
+        body = resp.json()
+    except (requests.exceptions.RequestException, ValueError):
+        with _stats_lock:
+            _errors[endpoint] += 1
+        return {'status': 'fail'}
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _latencies[endpoint].append(elapsed)
+    return body
+
+
+# Plan steps as the planner builds them
+_FORWARD = u'\u2191'
+_REVERSE = u'\u2193'
+_LEFT = u'\u2190'
+_RIGHT = u'\u2192'
+
+
+def _random_plan():
+    steps = []
+    for _ in range(random.randint(1, 8)):
+        kind = random.choice([_FORWARD, _REVERSE, _LEFT, _RIGHT, 'Grab', 'Release'])
+        if kind in ('Grab', 'Release'):
+            steps.append([kind])
+        elif kind in (_LEFT, _RIGHT):
+            steps.append([kind, round(random.uniform(0.25, 2), 2), 1.0])
+        else:
+            steps.append([kind, round(random.uniform(0.5, 3), 1)])
+    return json.dumps(steps)
+
+
+def _participant(clientId):
+    session = requests.Session()
+    named = {'clientId': clientId} if args.send_client_id else {}
+
+    # Wait for a robot
+    robot = None
+    while not _stop.is_set():
+        resp = _call(session, 'GET', 'robot_assignment', params={'clientId': clientId})
+        if resp.get('status') == 'ok':
+            robot = int(resp['robot_number'])
+            break
+        _stop.wait(1.0)
+
+    # Wait for the game to start
+    while not _stop.is_set():
+        if _call(session, 'GET', 'sol', params=named).get('status') == 'ok':
+            break
+        _stop.wait(0.5)
+
+    # Plan and send until the game ends
+    while not _stop.is_set():
+        if _call(session, 'GET', 'sol', params=named).get('status') != 'ok':
+            break
+        if _stop.wait(random.expovariate(1.0 / args.plan_time)):
+            break
+        posted = core.now()
+        resp = _call(session, 'POST', 'plan', data={'robot': robot, 'plan': _random_plan(), **named})
+        if resp.get('status') == 'ok' and resp.get('delay'):
+            with _stats_lock:
+                _expected[resp['plan_id']] = posted + resp['delay']
+            # the client animates the transmission for the whole delay
+            _stop.wait(resp['delay'] / args.time_scale)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def _report(elapsed):
+    print()
+    print(f'{args.clients} clients, {elapsed:.1f} s of game play')
+    print(f'{"endpoint":<20}{"requests":>10}{"errors":>8}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}')
+    total = 0
+    for endpoint in sorted(set(_latencies) | set(_errors)):
+        values = _latencies[endpoint]
+        total += len(values)
+        print(f'{endpoint:<20}{len(values):>10}{_errors[endpoint]:>8}{len(values) / elapsed:>9.1f}'
+              f'{_percentile(values, 50) * 1000:>9.1f}{_percentile(values, 95) * 1000:>9.1f}'
+              f'{_percentile(values, 99) * 1000:>9.1f}')
+    print(f'{"total":<20}{total:>10}{sum(_errors.values()):>8}{total / elapsed:>9.1f}')
+    print()
+    lateness = [late / args.time_scale for late in _dispatch_lateness]  # back to real seconds
+    print(f'plan dispatch lateness over {len(lateness)} plans: '
+          f'p50 {_percentile(lateness, 50) * 1000:.1f} ms, p95 {_percentile(lateness, 95) * 1000:.1f} ms, '
+          f'p99 {_percentile(lateness, 99) * 1000:.1f} ms, max {max(lateness, default=0) * 1000:.1f} ms')
+    mean_wait, max_wait = core.get_assignment_waits()
+    print(f'{len(core.get_waitlist())} clients still waiting for a robot; '
+          f'those assigned waited mean {mean_wait / args.time_scale:.1f} s, max {max_wait / args.time_scale:.1f} s')
+    for num in core.get_valid_robot_numbers():
+        held, busy, mean_wait, max_wait, dropped = core.get_dispatch_queue(num)
+        print(f'robot {num}: held for a busy robot mean {mean_wait / args.time_scale:.2f} s, '
+              f'max {max_wait / args.time_scale:.2f} s, {dropped} dropped')
+
+
+def main():
+    if args.time_scale != 1.0:
+        core.set_clock(clock.ScaledClock(args.time_scale))
+        mock_robot._time_scale = args.time_scale
+    core.RobotClass = _TimedMockRobot
+    core.startup(use_journal=False)
+    core.reconnect_all()
+    api_host._api_port = args.port
+    api_host.start()
+    engine.start(alerts=False)
+
+    core.set_game_config(args.minutes, args.sols, args.short_trip, args.long_trip)
+    core.set_auto_assign(True)
+
+    clients = [threading.Thread(target=_participant, args=(f'loadtest-{i}',), daemon=True)
+               for i in range(args.clients)]
+    for t in clients:
+        t.start()
+        time.sleep(0.01)  # participants trickle in rather than arriving in one burst
+
+    # Give everyone a moment to register, then play
+    time.sleep(2)
+    with _stats_lock:
+        _latencies.clear()
+        _errors.clear()
+    core.start_game()
+    start = time.time()
+    time.sleep(args.duration)
+    elapsed = time.time() - start
+
+    _stop.set()
+    core.abort_game()
+    with _stats_lock:
+        _report(elapsed)
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Counters and latency histograms for the host's hot paths, and an opt-in sampling profiler.
+# Modules create their metrics once at import and record into them from any thread; admin_host
+# serves render() at /metrics in the Prometheus text format.  Recording takes one short lock per
+# metric, so it is cheap enough for every request and every plan.
+
+_default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry_lock = threading.Lock()
+_registry: 'dict[str, object]' = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# A count that only goes up, one per combination of label values
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: 'dict[tuple, float]' = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in values]
+
+
+# Seconds spent in something, counted into fixed buckets, one series per combination of label values
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=_default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series: 'dict[tuple, list]' = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        # with histogram.time(): ... records how long the block took
+        return _Timer(self, label_values)
+
+    def get(self, *label_values):
+        # (count, sum) observed so far
+        with self._lock:
+            series = self._series.get(label_values)
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, (counts[:], total, count)) for key, (counts, total, count) in self._series.items())
+        lines = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _labels(self.labels, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {count}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._label_values)
+        return False
+
+
+# A Lock that records how long every acquire waited for it.
+# An uncontended acquire is recorded as no wait without reading the clock.
+class TimedLock:
+    def __init__(self, histogram, *label_values):
+        self._lock = threading.Lock()
+        self._histogram = histogram
+        self._label_values = label_values
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._histogram.observe(0.0, *self._label_values)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self._histogram.observe(time.perf_counter() - start, *self._label_values)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'Metric {name} is already registered as a {metric.kind}')
+        return metric
+
+
+def counter(name, help_text, labels=()) -> Counter:
+    # Returns the counter called name, creating it on first use
+    return _register(Counter, name, help_text, labels)
+
+
+def histogram(name, help_text, labels=(), buckets=_default_buckets) -> Histogram:
+    # Returns the histogram called name, creating it on first use
+    return _register(Histogram, name, help_text, labels, buckets)
+
+
+def render():
+    # Every metric in the Prometheus text exposition format, version 0.0.4
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Sampling profiler.  While running, a background thread records the Python stack of every
+# other thread every MARSBOTS_PROFILE_INTERVAL seconds.  get_profile() returns the samples
+# as folded stacks, one "thread;file:function;... count" line per distinct stack, which
+# flamegraph.pl and speedscope read directly.  Threads parked in a wait are sampled too, so
+# look below the waits for where the work goes.
+_profile_interval = float(os.environ.get('MARSBOTS_PROFILE_INTERVAL', 0.01))
+_profile_lock = threading.Lock()
+_profile_stacks: 'dict[str, int]' = defaultdict(int)
+_profile_samples = 0
+_profiler_thread = None
+_profiler_stop = threading.Event()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def _sample_stacks(own_id):
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = []
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == own_id:
+            continue
+        calls = []
+        while frame is not None:
+            calls.append(_frame_name(frame))
+            frame = frame.f_back
+        calls.append(names.get(thread_id, str(thread_id)))
+        stacks.append(';'.join(reversed(calls)))
+    return stacks
+
+
+def _profile(interval):
+    global _profile_samples
+    own_id = threading.get_ident()
+    while not _profiler_stop.wait(interval):
+        stacks = _sample_stacks(own_id)
+        with _profile_lock:
+            _profile_samples += 1
+            for stack in stacks:
+                _profile_stacks[stack] += 1
+
+
+def start_profiler(interval=None):
+    # Starts sampling, adding to any samples already taken.  Does nothing if already running.
+    global _profiler_thread
+    with _profile_lock:
+        if _profiler_thread is not None:
+            return
+        _profiler_stop.clear()
+        _profiler_thread = threading.Thread(target=_profile, args=(interval or _profile_interval,),
+                                            name='profiler', daemon=True)
+        _profiler_thread.start()
+    print('Sampling profiler started')
+
+
+def stop_profiler():
+    global _profiler_thread
+    with _profile_lock:
+        thread, _profiler_thread = _profiler_thread, None
+    if thread is None:
+        return
+    _profiler_stop.set()
+    thread.join()
+    print('Sampling profiler stopped')
+
+
+def profiler_running():
+    return _profiler_thread is not None
+
+
+def get_profile():
+    # (samples taken, folded stacks text, busiest stack first)
+    with _profile_lock:
+        stacks = sorted(_profile_stacks.items(), key=lambda item: -item[1])
+        samples = _profile_samples
+    return samples, ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+
+def reset_profile():
+    global _profile_samples
+    with _profile_lock:
+        _profile_stacks.clear()
+        _profile_samples = 0
@@ -1,9 +1,28 @@
+import os
+import threading
+import time
+from collections import deque
+
+import protocol
+import robot_model
+
+# Mock robots take as long as a real one would to run each plan, so load tests see
+# realistic execution time.  MARSBOTS_TIME_SCALE speeds them up along with the game clock.
+_time_scale = float(os.environ.get('MARSBOTS_TIME_SCALE', 1.0))
+
+
 class MockRobot:
     def __init__(self, robot_info):
         self.robot_ip_addr = None
         self.robot_mac_addr = robot_info['btmac']
         self.heard_ip_ad = False
         self.s = None
+        self.telemetry_handler = None
+
+        self._plans = deque()
+        self._cond = threading.Condition()
+        self._executor = threading.Thread(target=self._run, daemon=True)
+        self._executor.start()
 
     def connect(self):
         print('Connected to mock robot')
@@ -15,7 +34,7 @@ class MockRobot:
     def is_connected(self):
         return self.s is not None
 
-    def set_ip(self, addr):
+    def set_ip(self, addr, port=None):
         self.robot_ip_addr = addr
         self.heard_ip_ad = True
         self.connect()
@@ -23,7 +42,48 @@ class MockRobot:
     def close(self):
         print('Disconnected from mock robot')
         self.s = None
+        with self._cond:
+            self._plans.clear()
+
+    def shutdown(self):
+        self.close()
 
     def send_command(self, command):
-        if self.s is not None:
-            print("Send data to mock robot:", str(command))
+        if self.s is None:
+            return False
+        if command != 'ping':
+            with self._cond:
+                self._plans.append(command)
+                self._cond.notify()
+        return True
+
+    def get_link_stats(self):
+        with self._cond:
+            return len(self._plans), 0.0, 0.0, 0, 0.0
+
+    def get_link_health(self):
+        return ('ok' if self.s is not None else 'down'), 0.0, 0.0, 0.0
+
+    def _report(self, kind, plan_id, step=0, message=''):
+        if self.telemetry_handler is not None:
+            self.telemetry_handler(protocol.Telemetry(kind, plan_id, step, time.monotonic(), 0, 0, 0.0, message))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._plans:
+                    self._cond.wait()
+                plan = self._plans.popleft()
+            try:
+                plan_id, plan_steps = protocol.decode_plan(plan)
+            except ValueError as err:
+                print(f'Mock robot cannot run plan: {repr(err)}')
+                continue
+            steps = robot_model.compile_plan(plan_steps)
+            print("Mock robot running plan:", steps)
+            self._report(protocol.TM_ACCEPTED, plan_id, len(steps))
+            for step, duration in enumerate(robot_model.step_times(steps)):
+                self._report(protocol.TM_STEP_START, plan_id, step)
+                time.sleep(duration / _time_scale)
+                self._report(protocol.TM_STEP_END, plan_id, step)
+            self._report(protocol.TM_DONE, plan_id, len(steps))
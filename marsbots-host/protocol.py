@@ -0,0 +1,174 @@
+import json
+import math
+import struct
+from collections import namedtuple
+
+# Host <-> robot wire protocol.  Must match marsbot-ev3/remote.py
+#
+# Every message is a frame: 1 byte message type, 4 byte big-endian payload length, payload.
+# The host opens each connection with a HELLO carrying its protocol version and the robot
+# answers with its own.  The connection is dropped if the versions differ.
+# After that the host sends plans and pings, and the robot streams telemetry back and
+# answers each PING with a PONG carrying the same sequence number.
+PROTOCOL_VERSION = 4
+
+# Message types
+MSG_HELLO = 1
+MSG_PING = 2
+MSG_CLOSE = 4
+MSG_PLAN = 5  # replaces the pickled JSON command (3) of version 1
+MSG_TELEMETRY = 6  # robot -> host
+MSG_PONG = 7  # robot -> host
+
+_header = struct.Struct('!BI')
+_version = struct.Struct('!H')
+_sequence = struct.Struct('!I')  # PING and PONG payload
+
+# Anything larger than this is a corrupt stream rather than a real plan
+max_payload = 64 * 1024
+
+# A PLAN payload is a 4 byte plan id and a 2 byte step count, followed by one 5 byte step
+# per plan step: an opcode byte and a big-endian float argument (0 for the grabber).
+OP_FORWARD = 1
+OP_REVERSE = 2
+OP_LEFT = 3
+OP_RIGHT = 4
+OP_GRAB = 5
+OP_RELEASE = 6
+
+_plan_header = struct.Struct('!IH')
+_plan_step = struct.Struct('!Bf')
+max_plan_steps = 1000
+
+# Plan step names as the replit planner writes them
+_opcodes = {
+    u'\u2191': OP_FORWARD,  # up-arrow glyph
+    u'\u2193': OP_REVERSE,  # down-arrow glyph
+    u'\u2190': OP_LEFT,  # left-arrow glyph
+    u'\u2192': OP_RIGHT,  # right-arrow glyph
+    'Grab': OP_GRAB,
+    'Release': OP_RELEASE,
+}
+
+# A TELEMETRY payload is a fixed record, followed by a UTF-8 message for errors:
+#   kind, plan id, step, robot clock seconds, left and right wheel encoder degrees, battery volts
+# ACCEPTED carries the number of steps the robot will run once it has compiled the plan.
+# STATUS is sent several times a second whether or not a plan is running.
+TM_ACCEPTED = 1
+TM_STEP_START = 2
+TM_STEP_END = 3
+TM_DONE = 4
+TM_STATUS = 5
+TM_ERROR = 6
+
+_telemetry = struct.Struct('!BIHdiif')
+
+Telemetry = namedtuple('Telemetry', ['kind', 'plan_id', 'step', 'robot_time', 'left', 'right', 'battery',
+                                     'message'])
+
+
+def encode_frame(msg_type, payload=b''):
+    return _header.pack(msg_type, len(payload)) + payload
+
+
+def encode_hello():
+    return encode_frame(MSG_HELLO, _version.pack(PROTOCOL_VERSION))
+
+
+def decode_hello(payload):
+    return _version.unpack(payload)[0]
+
+
+def encode_ping(seq):
+    return encode_frame(MSG_PING, _sequence.pack(seq))
+
+
+def decode_pong(payload):
+    if len(payload) != _sequence.size:
+        raise ValueError('Malformed PONG')
+    return _sequence.unpack(payload)[0]
+
+
+def encode_plan(plan, plan_id):
+    # Planner JSON -> PLAN payload.  Raises ValueError if the plan is not one the robot can run.
+    try:
+        steps = json.loads(plan)
+    except (TypeError, ValueError):
+        raise ValueError('Plan is not valid JSON')
+    if not isinstance(steps, list):
+        raise ValueError('Plan must be a list of steps')
+    if len(steps) > max_plan_steps:
+        raise ValueError(f'Plan has more than {max_plan_steps} steps')
+    parts = [_plan_header.pack(plan_id, len(steps))]
+    for step in steps:
+        if not isinstance(step, list) or not step or not isinstance(step[0], str) or step[0] not in _opcodes:
+            raise ValueError(f'Unknown plan step {step!r}')
+        opcode = _opcodes[step[0]]
+        try:
+            value = float(step[1]) if len(step) > 1 and opcode not in (OP_GRAB, OP_RELEASE) else 0.0
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f'Bad value in plan step {step!r}')
+        if not math.isfinite(value):
+            raise ValueError(f'Bad value in plan step {step!r}')
+        try:
+            parts.append(_plan_step.pack(opcode, value))
+        except (OverflowError, struct.error):
+            raise ValueError(f'Value out of range in plan step {step!r}')
+    return b''.join(parts)
+
+
+def decode_plan(payload):
+    # PLAN payload -> (plan id, [(opcode, value), ...])
+    if len(payload) < _plan_header.size:
+        raise ValueError('Plan payload is too short')
+    plan_id, count = _plan_header.unpack_from(payload)
+    if len(payload) != _plan_header.size + count * _plan_step.size:
+        raise ValueError('Plan payload length does not match its step count')
+    return plan_id, list(_plan_step.iter_unpack(payload[_plan_header.size:]))
+
+
+def encode_telemetry(kind, plan_id=0, step=0, robot_time=0.0, left=0, right=0, battery=0.0, message=''):
+    payload = _telemetry.pack(kind, plan_id, step, robot_time, left, right, battery) + message.encode('utf-8')
+    return encode_frame(MSG_TELEMETRY, payload)
+
+
+def decode_telemetry(payload):
+    if len(payload) < _telemetry.size:
+        raise ValueError('Telemetry payload is too short')
+    fields = _telemetry.unpack_from(payload)
+    return Telemetry(*fields, payload[_telemetry.size:].decode('utf-8', 'replace'))
+
+
+# Reassembles whole messages from a byte stream.
+# feed() accepts whatever recv() returned and gives back the complete messages, if any;
+# partial frames are buffered until the rest arrives.
+class FrameDecoder:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        messages = []
+        start = 0
+        while len(self._buffer) - start >= _header.size:
+            msg_type, length = _header.unpack_from(self._buffer, start)
+            if length > max_payload:
+                raise ValueError(f'Frame of {length} bytes exceeds the protocol limit')
+            end = start + _header.size + length
+            if len(self._buffer) < end:
+                break
+            messages.append((msg_type, bytes(self._buffer[start + _header.size:end])))
+            start = end
+        del self._buffer[:start]
+        return messages
+
+
+def read_message(sock, decoder, pending):
+    # Blocks until one whole message is available.  pending holds messages already decoded
+    # from earlier reads.  Returns None if the connection closes first.
+    while not pending:
+        data = sock.recv(4096)
+        if not data:
+            return None
+        pending.extend(decoder.feed(data))
+    return pending.pop(0)
@@ -1,40 +1,82 @@
+import os
+import queue
+import random
 import socket
+import threading
+import time
 import bluetooth
-import pickle
+from collections import deque
+
+import metrics
+import protocol
 
 
 _bt_port = 3
 _tcp_port = 32390  # port number is arbitrary, but must match between server and client
+_connect_timeout = 5  # seconds allowed for each TCP or Bluetooth connect attempt
+_handshake_timeout = 5  # seconds to wait for the robot to answer HELLO
+_race_delay = 0.25  # head start given to TCP before Bluetooth joins the race
+_backoff_base = 1.0  # first reconnect delay in seconds, doubled on every failure
+_backoff_max = 30.0
+_send_timeout = 5  # seconds a write may stall before the link is considered lost
+_pings_size = 16  # heartbeats awaiting a PONG
+
+# Failure detector.  Robots send status several times a second and answer every heartbeat, so a
+# link that goes quiet for MARSBOTS_LINK_DEAD seconds is dropped and reconnected.  It is reported
+# degraded after half that, or while heartbeat round trips exceed MARSBOTS_LINK_SLOW_RTT seconds.
+_dead_after = float(os.environ.get('MARSBOTS_LINK_DEAD', 1.5))
+_slow_rtt = float(os.environ.get('MARSBOTS_LINK_SLOW_RTT', 0.25))
+_outbox_size = 16  # commands waiting to be written, per robot
+_stats_size = 32  # recent sends used for the latency average
 
+_send_seconds = metrics.histogram('marsbots_robot_send_seconds', 'Time to write a command to a robot link', ['robot'])
+_commands_dropped = metrics.counter('marsbots_robot_commands_dropped_total',
+                                    'Commands dropped because a robot link had fallen behind', ['robot'])
 
+
+# Each robot owns a worker thread that does all of its socket writes, and a reader thread
+# per connection that receives the robot's telemetry.
+# Callers only ever queue work for the worker, so a stalled link blocks nobody but itself.
+# telemetry_handler, if set, is called on the reader thread with each protocol.Telemetry.
 class RemoteRobot:
     def __init__(self, robot_info):
         self.robot_ip_addr = None
+        self.robot_tcp_port = _tcp_port
         self.robot_mac_addr = robot_info['btmac']
+        self.robot_number = robot_info['id']  # names the robot in metrics and the log; it may have no MAC
         self.heard_ip_ad = False
         self.s = None
+        self.telemetry_handler = None
+
+        self._cond = threading.Condition()
+        self._outbox = deque()
+        self._ping_pending = False  # keepalives are coalesced into this flag
+        self._connect_pending = False
+        self._close_pending = False
+        self._link_lost = False  # set by the reader, acted on by the worker
+        self._last_heard = 0.0
+        self._ping_seq = 0
+        self._pings_out: 'dict[int, float]' = {}  # sequence -> time sent
+        self._rtts: 'deque[float]' = deque(maxlen=_stats_size)
+        self._jitter = 0.0
+        self._running = True
+        self._send_times: 'deque[float]' = deque(maxlen=_stats_size)
+        self._dropped = 0
+
+        # Reconnect state, owned by the worker
+        self._want_connected = False
+        self._failures = 0
+        self._retry_at = None
+        self._connect_time = 0.0
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
 
     def connect(self):
-        # Try TCP first
-        if not self.s and self.robot_ip_addr:
-            try:
-                self.heard_ip_ad = False
-                self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.s.connect((self.robot_ip_addr, _tcp_port))
-                print('Connected to robot', self.robot_ip_addr)
-            except OSError as err:
-                self.s = None
-                print(f'Failed to open TCP connection to {self.robot_ip_addr}: {repr(err)}')
-
-        # If no TCP connection available, try Bluetooth
-        if not self.s:
-            try:
-                self.s = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-                self.s.connect((self.robot_mac_addr, _bt_port))
-                print('Connected to robot', self.robot_mac_addr)
-            except OSError as err:
-                self.s = None
-                print(f'Failed to open BT connection to {self.robot_mac_addr}: {repr(err)}')
+        with self._cond:
+            self._want_connected = True
+            self._connect_pending = True
+            self._cond.notify()
 
     def heard_ad(self):
         return self.heard_ip_ad
@@ -42,23 +84,329 @@ class RemoteRobot:
     def is_connected(self):
         return self.s is not None
 
-    def set_ip(self, addr):
+    def set_ip(self, addr, port=None):
         self.robot_ip_addr = addr
+        self.robot_tcp_port = port or _tcp_port
         self.heard_ip_ad = True
         self.connect()
 
     def close(self):
-        if self.s is not None:
-            self.send_command(None)
-            if self.s is not None:
-                self.s.close()
-            self.s = None
+        with self._cond:
+            self._want_connected = False
+            self._retry_at = None
+            self._outbox.clear()
+            self._ping_pending = False
+            self._connect_pending = False
+            self._close_pending = True
+            self._cond.notify()
 
+    def shutdown(self, timeout=2.0):
+        # Close the link and give the worker a moment to tell the robot
+        self.close()
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._worker.join(timeout)
+
+    # Queues a command for the worker and returns immediately.
+    # Returns False if the robot is not connected or its outbound queue is full.
     def send_command(self, command):
+        with self._cond:
+            if self.s is None:
+                return False
+            if command == 'ping':
+                self._ping_pending = True
+            elif len(self._outbox) >= _outbox_size:
+                self._dropped += 1
+                _commands_dropped.inc(str(self.robot_number))
+                print(f'Outbound queue full for robot {self.robot_number}, command dropped')
+                return False
+            else:
+                self._outbox.append(command)
+            self._cond.notify()
+        return True
+
+    def get_link_stats(self):
+        # (queue depth, last send ms, mean send ms, dropped commands, last connect ms)
+        with self._cond:
+            depth = len(self._outbox)
+            connect_ms = self._connect_time * 1000
+            if not self._send_times:
+                return depth, 0.0, 0.0, self._dropped, connect_ms
+            return (depth, self._send_times[-1] * 1000, sum(self._send_times) * 1000 / len(self._send_times),
+                    self._dropped, connect_ms)
+
+    def get_link_health(self):
+        # ('down' | 'ok' | 'degraded', heartbeat RTT ms, jitter ms, seconds since the robot was last heard)
+        with self._cond:
+            if self.s is None:
+                return 'down', 0.0, 0.0, 0.0
+            silent = time.monotonic() - self._last_heard
+            rtt = self._rtts[-1] if self._rtts else 0.0
+            state = 'degraded' if silent > _dead_after / 2 or rtt > _slow_rtt else 'ok'
+            return state, rtt * 1000, self._jitter * 1000, silent
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not (self._close_pending or self._link_lost or self._connect_pending
+                                             or self._outbox or self._ping_pending):
+                    now = time.monotonic()
+                    if self._retry_at is not None and self._retry_at <= now:
+                        self._retry_at = None
+                        self._connect_pending = True
+                        continue
+                    if self.s is not None and now - self._last_heard > _dead_after:
+                        print(f'Robot {self.robot_number} has gone quiet')
+                        self._link_lost = True
+                        continue
+                    deadlines = []
+                    if self._retry_at is not None:
+                        deadlines.append(self._retry_at)
+                    if self.s is not None:
+                        deadlines.append(self._last_heard + _dead_after)
+                    self._cond.wait(min(deadlines) - now + 0.01 if deadlines else None)
+                if self._close_pending or not self._running:
+                    self._close_pending = False
+                    action = 'close'
+                elif self._link_lost:
+                    self._link_lost = False
+                    action = 'lost'
+                elif self._connect_pending:
+                    self._connect_pending = False
+                    action = 'connect'
+                elif self._outbox:
+                    action = self._outbox.popleft()
+                else:
+                    self._ping_pending = False
+                    action = 'ping'
+                running = self._running
+
+            if action == 'close':
+                if self.s is not None:
+                    self._write(None)
+                    self._drop_link()
+                if not running:
+                    return
+            elif action == 'lost':
+                if self.s is not None:
+                    self._drop_link()
+                    print(f'Robot {self.robot_number} disconnected from {self.robot_ip_addr}')
+            elif action == 'connect':
+                self._open()
+            else:
+                self._write(action)
+
+    def _open(self):
         if self.s is not None:
-            data = pickle.dumps(command, protocol=4)
+            return
+
+        # Race TCP against Bluetooth, TCP first since it is the faster link
+        attempts = []
+        if self.robot_ip_addr:
+            self.heard_ip_ad = False
+            attempts.append(('TCP', self.robot_ip_addr, self._open_tcp))
+        if self.robot_mac_addr:
+            attempts.append(('BT', self.robot_mac_addr, self._open_bt))
+        if not attempts:
+            return  # reached over IP only, and not heard from yet
+
+        start = time.perf_counter()
+        winner = self._race(attempts)
+        elapsed = time.perf_counter() - start
+
+        with self._cond:
+            if winner is None:
+                self._schedule_retry()
+                return
+            if not self._want_connected:
+                # Closed by the operator while we were connecting
+                winner[2].close()
+                return
+            kind, addr, self.s = winner
+            self._failures = 0
+            self._connect_time = elapsed
+            self._last_heard = time.monotonic()
+            self._link_lost = False
+            self._pings_out.clear()
+            self._rtts.clear()
+            self._jitter = 0.0
+        threading.Thread(target=self._read, args=(self.s,), daemon=True).start()
+        print(f'Connected to robot {self.robot_number} at {addr} over {kind} in {elapsed * 1000:.0f} ms')
+
+    def _read(self, s):
+        # Reader for one connection.  Exits when the socket closes, which the worker does when
+        # dropping the link; if the robot closes it first, the worker is told to drop it.
+        decoder = protocol.FrameDecoder()
+        while True:
             try:
-                self.s.send(data)
-            except OSError:
-                self.s = None
-                print('Robot disconnected', self.robot_ip_addr)
+                data = s.recv(4096)
+                messages = decoder.feed(data) if data else None
+            except socket.timeout:
+                continue  # quiet links are caught by the worker's silence check
+            except (OSError, ValueError):
+                messages = None
+            if not messages:
+                if messages is None:
+                    break
+                continue
+            with self._cond:
+                if self.s is not s:
+                    return
+                self._last_heard = time.monotonic()
+            for msg_type, payload in messages:
+                if msg_type == protocol.MSG_PONG:
+                    self._pong(payload)
+                    continue
+                if msg_type != protocol.MSG_TELEMETRY or self.telemetry_handler is None:
+                    continue
+                try:
+                    telemetry = protocol.decode_telemetry(payload)
+                except ValueError as err:
+                    print(f'Bad telemetry from robot {self.robot_number}: {repr(err)}')
+                    continue
+                try:
+                    self.telemetry_handler(telemetry)
+                except Exception as err:
+                    print(f'Telemetry handler failed: {repr(err)}')
+        with self._cond:
+            if self.s is s:
+                self._link_lost = True
+                self._cond.notify()
+
+    def _pong(self, payload):
+        received = time.perf_counter()
+        try:
+            seq = protocol.decode_pong(payload)
+        except ValueError as err:
+            print(f'Bad heartbeat reply from robot {self.robot_number}: {repr(err)}')
+            return
+        with self._cond:
+            sent = self._pings_out.pop(seq, None)
+            if sent is None:
+                return
+            rtt = received - sent
+            # smoothed like RTP's interarrival jitter (RFC 3550)
+            if self._rtts:
+                self._jitter += (abs(rtt - self._rtts[-1]) - self._jitter) / 16
+            self._rtts.append(rtt)
+
+    def _race(self, attempts):
+        # Starts each attempt a little after the previous one and returns (kind, addr, socket)
+        # for the first to complete its handshake.  Later winners close their own sockets.
+        results = queue.Queue()
+        claimed = threading.Event()
+        claim_lock = threading.Lock()
+
+        def attempt(delay, kind, addr, opener):
+            if claimed.wait(delay):
+                results.put(None)
+                return
+            s = opener(addr)
+            with claim_lock:
+                if s is not None and not claimed.is_set():
+                    claimed.set()
+                    results.put((kind, addr, s))
+                    return
+            if s is not None:
+                s.close()
+            results.put(None)
+
+        for i, (kind, addr, opener) in enumerate(attempts):
+            threading.Thread(target=attempt, args=(i * _race_delay, kind, addr, opener), daemon=True).start()
+        for _ in attempts:
+            result = results.get()
+            if result is not None:
+                return result
+        return None
+
+    def _open_tcp(self, addr):
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(_connect_timeout)
+            s.connect((addr, self.robot_tcp_port))
+        except OSError as err:
+            print(f'Failed to open TCP connection to {addr}: {repr(err)}')
+            return None
+        return s if self._handshake(s) else None
+
+    def _open_bt(self, addr):
+        try:
+            s = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+            s.settimeout(_connect_timeout)
+            s.connect((addr, _bt_port))
+        except OSError as err:
+            print(f'Failed to open BT connection to {addr}: {repr(err)}')
+            return None
+        return s if self._handshake(s) else None
+
+    def _schedule_retry(self):
+        # Called holding the condition.  Exponential backoff with jitter so a room full of
+        # robots that dropped together does not retry in lockstep.
+        if not self._want_connected:
+            return
+        delay = min(_backoff_max, _backoff_base * 2 ** self._failures) * random.uniform(0.5, 1.0)
+        self._failures += 1
+        self._retry_at = time.monotonic() + delay
+        print(f'Retrying robot {self.robot_number} in {delay:.1f} s')
+
+    def _handshake(self, s):
+        # Exchange protocol versions before any commands are sent
+        try:
+            s.settimeout(_handshake_timeout)
+            s.sendall(protocol.encode_hello())
+            reply = protocol.read_message(s, protocol.FrameDecoder(), [])
+            s.settimeout(_send_timeout)
+        except (OSError, ValueError) as err:
+            print(f'Handshake with robot failed: {repr(err)}')
+            s.close()
+            return False
+        if reply is None or reply[0] != protocol.MSG_HELLO:
+            print('Robot did not answer the protocol handshake')
+            s.close()
+            return False
+        version = protocol.decode_hello(reply[1])
+        if version != protocol.PROTOCOL_VERSION:
+            print(f'Robot speaks protocol version {version}, host expects {protocol.PROTOCOL_VERSION}')
+            s.close()
+            return False
+        return True
+
+    def _write(self, command):
+        if self.s is None:
+            return
+        if command is None:
+            data = protocol.encode_frame(protocol.MSG_CLOSE)
+        elif command == 'ping':
+            with self._cond:
+                self._ping_seq += 1
+                self._pings_out[self._ping_seq] = time.perf_counter()
+                if len(self._pings_out) > _pings_size:
+                    del self._pings_out[next(iter(self._pings_out))]
+                data = protocol.encode_ping(self._ping_seq)
+        else:
+            data = protocol.encode_frame(protocol.MSG_PLAN, command)
+        start = time.perf_counter()
+        try:
+            self.s.sendall(data)
+        except OSError:
+            self._drop_link()
+            print(f'Robot {self.robot_number} disconnected from {self.robot_ip_addr}')
+            return
+        elapsed = time.perf_counter() - start
+        _send_seconds.observe(elapsed, str(self.robot_number))
+        with self._cond:
+            self._send_times.append(elapsed)
+
+    def _drop_link(self):
+        s = self.s
+        with self._cond:
+            self.s = None
+            self._outbox.clear()
+            self._ping_pending = False
+            self._link_lost = False
+            self._schedule_retry()
+        try:
+            s.close()
+        except OSError:
+            pass
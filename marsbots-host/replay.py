@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import csv
+import io
+import os
+import time
+
+# Replays a recorded game from the journal through core's scheduler and dispatch queues, into
+# simulated robots that take as long as real ones to run each plan.  Time is virtual, so a whole
+# game replays in moments and the same journal always gives the same result.  Every plan is
+# submitted at the moment it was in the room; override the game settings to see how a different
+# light delay or game length would have changed the queueing.
+os.environ['MOCK_ROBOT'] = '1'
+
+import clock
+import core
+import journal
+import protocol
+import robot_model
+
+parser = argparse.ArgumentParser(description='Replay a recorded Marsbot game against simulated robots')
+parser.add_argument('--journal-dir', default=journal._journal_dir, help='where the host kept its journal')
+parser.add_argument('--list', action='store_true', help='list the recorded games and exit')
+parser.add_argument('--game', help='id of the game to replay, or a unique prefix; defaults to the latest')
+parser.add_argument('--minutes', type=int, help='game length in minutes, instead of the recorded one')
+parser.add_argument('--sols', type=int)
+parser.add_argument('--short-trip', type=int, help='light delay at game start, seconds')
+parser.add_argument('--long-trip', type=int, help='light delay at game end, seconds')
+parser.add_argument('--timeline', action='store_true', help='print every plan, robot by robot')
+parser.add_argument('--csv', help='write every plan to this CSV file')
+parser.add_argument('--verbose', action='store_true', help="show the host's own log while replaying")
+args = parser.parse_args()
+
+_drain_time = 120  # seconds of game time allowed after the end for robots to finish
+
+# Timeline of each replayed plan, by plan id:
+#   robot, kind ('plan' or 'rescue'), submit, delay, recorded_delay - game seconds
+#   sent - when the robot was handed the plan, None if it never was
+#   start, end - when the robot ran it
+_timeline: 'dict[int, dict]' = {}
+_columns = ['plan_id', 'robot', 'kind', 'submit', 'delay', 'recorded_delay', 'sent', 'start', 'end']
+
+
+# A robot that runs plans in virtual time, one after another, for as long as robot_model says
+# the real one would take, and reports back to core as the real one does
+class _ReplayRobot:
+    def __init__(self, robot_info):
+        self.robot_ip_addr = None
+        self.robot_mac_addr = robot_info['btmac']
+        self.heard_ip_ad = False
+        self.s = None
+        self.telemetry_handler = None
+        self._free_at = 0.0
+
+    def connect(self):
+        self.s = True
+
+    def heard_ad(self):
+        return self.heard_ip_ad
+
+    def is_connected(self):
+        return self.s is not None
+
+    def set_ip(self, addr, port=None):
+        self.robot_ip_addr = addr
+        self.connect()
+
+    def close(self):
+        self.s = None
+
+    def shutdown(self):
+        self.close()
+
+    def get_link_stats(self):
+        return 0, 0.0, 0.0, 0, 0.0
+
+    def get_link_health(self):
+        return ('ok' if self.s is not None else 'down'), 0.0, 0.0, 0.0
+
+    def send_command(self, command):
+        if self.s is None:
+            return False
+        if command == 'ping':
+            return True
+        plan_id, plan_steps = protocol.decode_plan(command)
+        steps = robot_model.compile_plan(plan_steps)
+        now = core.now()
+        start = max(now, self._free_at)
+        self._free_at = start + robot_model.plan_duration(steps)
+        row = _timeline.get(plan_id)
+        if row is not None:
+            row.update(sent=now, start=start, end=self._free_at)
+        self._report(protocol.TM_ACCEPTED, plan_id, len(steps))
+        core.call_at(self._free_at, self._report, protocol.TM_DONE, plan_id, len(steps))
+        return True
+
+    def _report(self, kind, plan_id, step):
+        if self.telemetry_handler is not None:
+            self.telemetry_handler(protocol.Telemetry(kind, plan_id, step, core.now(), 0, 0, 0.0, ''))
+
+
+def _recorded_games(records):
+    # [(game_start record, records made during that game)], oldest first
+    games = []
+    current = None
+    for rec in records:
+        if rec['kind'] == 'game_start':
+            current = (rec, [])
+            games.append(current)
+        elif rec['kind'] == 'game_end':
+            current = None
+        elif current is not None:
+            current[1].append(rec)
+    return games
+
+
+def _list_games(games):
+    for start, records in games:
+        minutes, sols, short_trip, long_trip = start['config']
+        plans = sum(1 for rec in records if rec['kind'] == 'plan')
+        print(f'{start["game_id"]}  {time.ctime(start["wall_base"])}  {minutes} min, {sols} sols, '
+              f'{short_trip}-{long_trip} s delay, {plans} plans')
+
+
+def _replay(start, records, config):
+    minutes = config[0]
+    scale = start.get('time_scale', 1.0)  # journal times are wall clock, a rehearsal's game clock ran faster
+    core.set_clock(clock.VirtualClock())
+    core.RobotClass = _ReplayRobot
+    core.startup(use_journal=False)
+    core.reconnect_all()
+    core.set_game_config(*config)
+    core.start_game()
+
+    for rec in records:
+        if rec['kind'] != 'plan':
+            continue
+        core.run_for(max(0.0, (rec['t'] - start['wall_base']) * scale - core.now()))
+        delay, plan_id = core.queue_plan(rec['robot'], rec['plan'])
+        if not plan_id:
+            continue  # submitted after the replayed game had ended
+        _timeline[plan_id] = {
+            'plan_id': plan_id, 'robot': rec['robot'], 'kind': 'plan' if rec['plan'] is not None else 'rescue',
+            'submit': core.now(), 'delay': delay, 'recorded_delay': (rec['due'] - rec['t']) * scale,
+            'sent': None, 'start': None, 'end': None,
+        }
+    # Play out the rest of the game, then let the robots finish what they were sent
+    core.run_for(max(0.0, minutes * 60 - core.now()))
+    core.run_for(_drain_time)
+    core.shutdown()
+
+
+def _report(config, submitted):
+    minutes, sols, short_trip, long_trip = config
+    print(f'Replayed {minutes} min, {sols} sols, {short_trip}-{long_trip} s light delay: '
+          f'{len(_timeline)} of {submitted} plans submitted in time')
+    print(f'{"robot":<7}{"plans":>7}{"run":>6}{"lost":>6}{"rescues":>9}{"delay s":>9}{"held s":>8}'
+          f'{"max held":>10}{"busy %":>8}')
+    for num in core.get_valid_robot_numbers():
+        rows = [row for row in _timeline.values() if row['robot'] == num]
+        plans = [row for row in rows if row['kind'] == 'plan']
+        run = [row for row in plans if row['sent'] is not None]
+        held = [row['sent'] - row['submit'] - row['delay'] for row in run]
+        busy = sum(row['end'] - row['start'] for row in run)
+        mean_delay = sum(row['delay'] for row in plans) / len(plans) if plans else 0.0
+        print(f'{num:<7}{len(plans):>7}{len(run):>6}{len(plans) - len(run):>6}{len(rows) - len(plans):>9}'
+              f'{mean_delay:>9.1f}{sum(held) / len(held) if held else 0.0:>8.1f}{max(held, default=0.0):>10.1f}'
+              f'{busy * 100 / (minutes * 60):>8.1f}')
+
+    if args.timeline:
+        for num in core.get_valid_robot_numbers():
+            rows = sorted((r for r in _timeline.values() if r['robot'] == num), key=lambda r: r['submit'])
+            if not rows:
+                continue
+            print()
+            print(f'Robot {num}')
+            for row in rows:
+                if row['kind'] == 'rescue':
+                    print(f'  {row["submit"]:8.1f}  rescue    delay {row["delay"]:5.1f}')
+                elif row['sent'] is None:
+                    print(f'  {row["submit"]:8.1f}  plan {row["plan_id"]:<4} delay {row["delay"]:5.1f}  never run')
+                else:
+                    print(f'  {row["submit"]:8.1f}  plan {row["plan_id"]:<4} delay {row["delay"]:5.1f}  '
+                          f'sent {row["sent"]:8.1f}  ran {row["start"]:8.1f} - {row["end"]:8.1f}')
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=_columns)
+            writer.writeheader()
+            writer.writerows(sorted(_timeline.values(), key=lambda r: r['submit']))
+        print(f'Wrote {len(_timeline)} plans to {args.csv}')
+
+
+def main():
+    games = _recorded_games(journal.read_all(args.journal_dir))
+    if not games:
+        print(f'No games recorded in {args.journal_dir}')
+        return
+    if args.list:
+        _list_games(games)
+        return
+
+    matches = [g for g in games if g[0]['game_id'].startswith(args.game)] if args.game else games[-1:]
+    if len(matches) != 1:
+        print(f'{len(matches)} recorded games match {args.game}; use --list to see them')
+        return
+    start, records = matches[0]
+
+    recorded = start['config']
+    overrides = [args.minutes, args.sols, args.short_trip, args.long_trip]
+    config = [override if override is not None else value for override, value in zip(overrides, recorded)]
+    submitted = sum(1 for rec in records if rec['kind'] == 'plan')
+
+    log = None if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(log) if log else contextlib.nullcontext():
+        _replay(start, records, config)
+    _report(config, submitted)
+
+
+if __name__ == '__main__':
+    main()
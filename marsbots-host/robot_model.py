@@ -0,0 +1,80 @@
+import protocol
+
+# What a Marsbot does with a plan, and how long it takes.
+# Steps use the wire opcodes; the motion constants mirror marsbot-ev3/robot.py.
+
+FORWARD = protocol.OP_FORWARD
+REVERSE = protocol.OP_REVERSE
+LEFT = protocol.OP_LEFT
+RIGHT = protocol.OP_RIGHT
+GRAB = protocol.OP_GRAB
+RELEASE = protocol.OP_RELEASE
+
+drive_speed = 35  # percent of full motor speed
+turn_speed = 35
+turn_rotations = 0.4925  # wheel rotations per unit of turn, from robot.turn()
+
+_max_speed = 1050  # degrees per second of an EV3 large motor at 100%
+_settle_time = 0.05  # braking to a stop at the end of each on_for_rotations
+_grab_time = 0.6  # 0.2 s head start plus the grabber closing until it stalls
+_release_time = 0.6
+_epsilon = 1e-6
+
+
+def compile_plan(plan_steps):
+    # Decoded plan steps -> [(cmd, value), ...] as the robot runs them.
+    # Like marsbot-ev3/plan_compiler.py, adjacent legs on the same axis merge into one signed
+    # FORWARD or RIGHT, legs that cancel out vanish and repeated grabber steps collapse.
+    steps = []
+    for cmd, value in plan_steps:
+        if cmd == REVERSE:
+            cmd, value = FORWARD, -value
+        elif cmd == LEFT:
+            cmd, value = RIGHT, -value
+        elif cmd not in (FORWARD, RIGHT, GRAB, RELEASE):
+            continue
+        if steps and steps[-1][0] == cmd:
+            if cmd in (FORWARD, RIGHT):
+                value += steps.pop()[1]
+                if abs(value) > _epsilon:
+                    steps.append((cmd, value))
+            continue
+        if cmd in (FORWARD, RIGHT) and abs(value) <= _epsilon:
+            continue
+        steps.append((cmd, value))
+    return steps
+
+
+def _rotation_time(rotations, speed):
+    return abs(rotations) * 360.0 / (_max_speed * speed / 100.0) + _settle_time
+
+
+def step_duration(cmd, value):
+    if cmd in (FORWARD, REVERSE):
+        return _rotation_time(value, drive_speed)
+    if cmd in (LEFT, RIGHT):
+        return _rotation_time(value * turn_rotations, turn_speed)
+    if cmd == GRAB:
+        return _grab_time
+    if cmd == RELEASE:
+        return _release_time
+    return 0.0
+
+
+def step_times(steps):
+    # Seconds each step holds up the plan.  A release runs alongside a following reverse, as
+    # plan_compiler allows on the robot, so the reverse lasts until both have finished.
+    times = []
+    overlapped = 0.0
+    for i, (cmd, value) in enumerate(steps):
+        duration = max(step_duration(cmd, value), overlapped)
+        overlapped = 0.0
+        following = steps[i + 1] if i + 1 < len(steps) else None
+        if cmd == RELEASE and following and following[0] == FORWARD and following[1] < 0:
+            overlapped, duration = duration, 0.0
+        times.append(duration)
+    return times
+
+
+def plan_duration(steps):
+    return sum(step_times(steps))
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+
+import clock
+import metrics
+
+
+# Number of recent dispatches kept for lateness reporting
+_history_size = 256
+
+_lateness_seconds = metrics.histogram('marsbots_dispatch_lateness_seconds',
+                                      'How long after its due time a scheduled entry ran')
+_dispatch_seconds = metrics.histogram('marsbots_dispatch_seconds', 'Time spent running a scheduled entry')
+
+
+# Runs callbacks at their due time from a dedicated thread.
+# Entries are kept in a heap keyed on due time, so the thread sleeps exactly
+# until the next deadline and is woken early whenever an earlier entry arrives.
+class Scheduler:
+    def __init__(self, game_clock=None):
+        self._clock = game_clock or clock.MonotonicClock()
+        self._heap = []
+        self._seq = itertools.count()  # tie-breaker keeps equal due times in FIFO order
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._lateness: 'deque[float]' = deque(maxlen=_history_size)
+        self._dispatched = 0
+
+    def start(self):
+        # Manual clocks are driven by run_until() instead of a thread
+        if self._clock.manual:
+            return
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, due, func, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), func, args))
+            # Only wake the thread if this entry is now the next deadline
+            if self._heap[0][0] == due:
+                self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            self._heap = []
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def next_due(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def run_until(self, t):
+        # Steps a manual clock through every entry due up to t, dispatching on this thread.
+        # Entries scheduled by a dispatch are picked up in the same run if they fall before t.
+        while True:
+            with self._cond:
+                if not self._heap or self._heap[0][0] > t:
+                    break
+                entry = heapq.heappop(self._heap)
+            self._clock.advance_to(entry[0])
+            self._dispatch(entry)
+        self._clock.advance_to(t)
+
+    def get_lateness(self):
+        # Returns (dispatch count, last, max, mean) lateness in seconds over recent dispatches
+        with self._cond:
+            if not self._lateness:
+                return self._dispatched, 0.0, 0.0, 0.0
+            return (self._dispatched, self._lateness[-1], max(self._lateness),
+                    sum(self._lateness) / len(self._lateness))
+
+    def _pop_due(self):
+        # Called holding the condition; blocks until an entry is due or the scheduler stops
+        while self._running:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            wait = self._heap[0][0] - self._clock.now()
+            if wait <= 0:
+                return heapq.heappop(self._heap)
+            self._clock.wait(self._cond, wait)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                entry = self._pop_due()
+                if entry is None:
+                    return
+            self._dispatch(entry)
+
+    def _dispatch(self, entry):
+        due, _, func, args = entry
+        late = self._clock.now() - due
+        with self._cond:
+            self._lateness.append(late)
+            self._dispatched += 1
+        _lateness_seconds.observe(late)
+        with _dispatch_seconds.time():
+            try:
+                func(*args)
+            except Exception as err:
+                print(f'Scheduled dispatch failed: {repr(err)}')
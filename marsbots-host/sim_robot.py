@@ -0,0 +1,177 @@
+import argparse
+import queue
+import socket
+import threading
+import time
+
+import protocol
+import robot_model
+
+# Simulated Marsbots that speak the real robot protocol over TCP.
+# Each one listens like marsbot-ev3/robot.py, advertises itself to the host, answers the
+# handshake, executes plans for as long as the real motors would take and streams telemetry
+# back just as the EV3 does.  Run a fleet of them next to the host to exercise connects,
+# pings, telemetry and backpressure without hardware.
+
+_ad_port = 32391
+_accept_timeout = 5  # the robot advertises once per accept timeout while waiting
+_recv_timeout = 2  # as the EV3: the host pings twice a second
+_status_interval = 0.25  # seconds between status reports, as on the EV3
+_battery = 7.8  # volts reported, a freshly charged EV3
+
+
+class SimRobot:
+    def __init__(self, name, port, time_scale=1.0, ad_addr='127.0.0.1'):
+        self.name = name
+        self.port = port
+        self.time_scale = time_scale
+        self.ad_addr = ad_addr
+        self.plans_run = 0
+        self.busy_time = 0.0
+        self._running = False
+        self._listener = None
+        self._thread = None
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('0.0.0.0', self.port))
+        self._listener.listen(1)
+        self._listener.settimeout(_accept_timeout)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._listener.close()
+
+    def _advertise(self):
+        # Real robots broadcast their hostname; simulated ones add the port they listen on
+        ad = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        ad.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        ad.sendto(f'{self.name}:{self.port}'.encode('utf-8'), (self.ad_addr, _ad_port))
+        ad.close()
+
+    def _serve(self):
+        while self._running:
+            self._advertise()
+            try:
+                client, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            client.settimeout(_recv_timeout)
+            try:
+                self._drive(client)
+            except (OSError, ValueError) as err:
+                print(f'{self.name}: connection lost: {repr(err)}')
+            client.close()
+
+    def _drive(self, client):
+        decoder = protocol.FrameDecoder()
+        pending = []
+        hello = protocol.read_message(client, decoder, pending)
+        if hello is None or hello[0] != protocol.MSG_HELLO:
+            return
+        client.sendall(protocol.encode_hello())
+        if protocol.decode_hello(hello[1]) != protocol.PROTOCOL_VERSION:
+            return
+        print(f'{self.name}: connected')
+
+        # Like the EV3, plans run on their own thread while this one keeps reading, and a
+        # status report goes out several times a second
+        link = _Link(client)
+        plans = queue.Queue()
+        executor = threading.Thread(target=self._execute, args=(link, plans), daemon=True)
+        executor.start()
+        threading.Thread(target=self._report_status, args=(link,), daemon=True).start()
+        try:
+            while self._running:
+                message = protocol.read_message(client, decoder, pending)
+                if message is None or message[0] == protocol.MSG_CLOSE:
+                    break
+                if message[0] == protocol.MSG_PING:
+                    link.pong(message[1])
+                elif message[0] == protocol.MSG_PLAN:
+                    plan_id, plan_steps = protocol.decode_plan(message[1])
+                    steps = robot_model.compile_plan(plan_steps)
+                    link.send(protocol.TM_ACCEPTED, plan_id, len(steps))
+                    plans.put((plan_id, steps))
+        finally:
+            link.closed.set()
+            plans.put(None)
+            executor.join()
+        print(f'{self.name}: disconnected')
+
+    def _report_status(self, link):
+        while not link.closed.wait(_status_interval):
+            link.send(protocol.TM_STATUS, battery=_battery)
+
+    def _execute(self, link, plans):
+        while True:
+            plan = plans.get()
+            if plan is None:
+                return
+            plan_id, steps = plan
+            start = time.perf_counter()
+            for step, duration in enumerate(robot_model.step_times(steps)):
+                link.send(protocol.TM_STEP_START, plan_id, step)
+                time.sleep(duration / self.time_scale)
+                link.send(protocol.TM_STEP_END, plan_id, step)
+            link.send(protocol.TM_DONE, plan_id, len(steps))
+            self.plans_run += 1
+            self.busy_time += time.perf_counter() - start
+
+
+# One connection's telemetry sender, shared by the threads serving it
+class _Link:
+    def __init__(self, client):
+        self.client = client
+        self.closed = threading.Event()
+        self._lock = threading.Lock()
+
+    def send(self, kind, plan_id=0, step=0, battery=0.0, message=''):
+        frame = protocol.encode_telemetry(kind, plan_id, step, time.monotonic(), battery=battery, message=message)
+        with self._lock:
+            try:
+                self.client.sendall(frame)
+            except OSError:
+                pass  # the reading thread notices the connection has gone
+
+    def pong(self, payload):
+        with self._lock:
+            try:
+                self.client.sendall(protocol.encode_frame(protocol.MSG_PONG, payload))
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fleet of simulated Marsbots')
+    parser.add_argument('--count', type=int, default=6, help='number of robots')
+    parser.add_argument('--base-port', type=int, default=42000, help='first robot listens here, the rest follow')
+    parser.add_argument('--names', help='comma separated robot names, matching the host fleet')
+    parser.add_argument('--host', default='127.0.0.1', help='address to send advertisements to')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='execute plans this many times faster')
+    args = parser.parse_args()
+
+    names = args.names.split(',') if args.names else [f'sim-robot-{i + 1}' for i in range(args.count)]
+    fleet = [SimRobot(name, args.base_port + i, args.time_scale, args.host) for i, name in enumerate(names)]
+    for robot in fleet:
+        robot.start()
+    print(f'Running {len(fleet)} simulated robots, press Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for robot in fleet:
+        robot.stop()
+        print(f'{robot.name}: {robot.plans_run} plans, {robot.busy_time:.1f} s driving')
+
+
+if __name__ == '__main__':
+    main()
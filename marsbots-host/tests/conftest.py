@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The host is a directory of flat modules rather than a package, and the robot's plan compiler
+# lives beside it in marsbot-ev3, so both go on the path for the tests.
+_host_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(_host_dir), 'marsbot-ev3'))
+sys.path.insert(0, _host_dir)
@@ -0,0 +1,73 @@
+import clients
+
+
+def test_waitlist_is_first_come_first_served():
+    registry = clients.ClientRegistry()
+    for i, name in enumerate(['c', 'a', 'b']):
+        registry.add(name, float(i))
+    assert list(registry.waitlist()) == ['c', 'a', 'b']
+    assert registry.assign('a', 1, 5.0) == 4.0  # seconds it waited
+    assert list(registry.waitlist()) == ['c', 'b']
+
+
+def test_released_client_rejoins_at_the_end():
+    registry = clients.ClientRegistry()
+    registry.add('a', 0.0)
+    registry.add('b', 1.0)
+    registry.assign('a', 1, 2.0)
+    assert not registry.join('a', 3.0)  # still has a robot
+    assert registry.release_robot(1) == 'a'
+    assert registry.join('a', 3.0)
+    assert not registry.join('a', 4.0)  # already waiting
+    assert list(registry.waitlist()) == ['b', 'a']
+    assert registry.joined('a') == 3.0
+
+
+def test_assignments_are_one_to_one():
+    registry = clients.ClientRegistry()
+    registry.add('a', 0.0)
+    registry.add('b', 0.0)
+    assert registry.assign('a', 1, 1.0) is not None
+    assert registry.assign('b', 1, 1.0) is None
+    assert registry.assign('a', 2, 1.0) is None
+    assert registry.robot_of('a') == 1 and registry.client_of(1) == 'a'
+    assert registry.release_client('a') == 1
+    assert registry.client_of(1) is None
+
+
+def test_cap_evicts_the_longest_silent_unassigned_clients():
+    registry = clients.ClientRegistry(max_clients=3)
+    registry.add('seated', 0.0)
+    registry.assign('seated', 1, 0.0)
+    registry.add('old', 1.0)
+    registry.add('newer', 2.0)
+    registry.touch('old', 3.0)
+    assert registry.add('newest', 4.0) == ['newer']
+    assert set(registry.clients()) == {'seated', 'old', 'newest'}
+    assert list(registry.waitlist()) == ['old', 'newest']
+
+
+def test_assigned_clients_are_never_evicted():
+    registry = clients.ClientRegistry(idle_timeout=10, max_clients=1)
+    registry.add('seated', 0.0)
+    registry.assign('seated', 1, 0.0)
+    assert registry.add('other', 1.0) == ['other']
+    assert registry.evict_idle(100.0) == []
+    assert 'seated' in registry
+
+
+def test_idle_clients_are_forgotten():
+    registry = clients.ClientRegistry(idle_timeout=10)
+    registry.add('quiet', 0.0)
+    registry.add('busy', 0.0)
+    registry.touch('busy', 8.0)
+    assert registry.evict_idle(15.0) == ['quiet']
+    assert 'quiet' not in registry
+    assert list(registry.waitlist()) == ['busy']
+
+
+def test_touch_does_not_remember_unknown_clients():
+    registry = clients.ClientRegistry()
+    registry.touch('stranger', 1.0)
+    assert 'stranger' not in registry
+    assert len(registry) == 0
@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+
+import fleet
+
+_robots = [
+    {'id': 1, 'name': 'ev3dev-ssci-25', 'btmac': '00:17:e9:b3:e3:57'},
+    {'id': 2, 'name': 'ev3dev-ssci-26', 'btmac': None},
+]
+
+
+def _write(path, robots, mtime):
+    path.write_text(json.dumps({'robots': robots}), encoding='utf-8')
+    os.utime(path, (mtime, mtime))  # file systems with coarse timestamps would miss quick edits
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'fleet.json'
+    _write(path, _robots, 1000)
+    return path
+
+
+def test_load_reads_the_fleet(path):
+    robots = fleet.Fleet(str(path), None)
+    added, removed, changed = robots.load()
+    assert [rid['id'] for rid in added] == [1, 2]
+    assert removed == [] and changed == []
+    assert robots.get(1)['btmac'] == '00:17:E9:B3:E3:57'
+    assert robots.find(name='ev3dev-ssci-26') == 2
+    assert robots.find(mac='00:17:E9:B3:E3:57') == 1
+    assert not robots.changed()
+
+
+def test_load_keeps_only_this_arenas_robots(path):
+    robots = fleet.Fleet(str(path), {2})
+    robots.load()
+    assert [rid['id'] for rid in robots.robots()] == [2]
+    assert robots.heard('ev3dev-ssci-25', '10.0.0.1') is None
+    assert not robots.offer('ev3dev-ssci-25', '10.0.0.1', None, 0.0)
+
+
+def test_reload_reports_what_changed(path):
+    robots = fleet.Fleet(str(path), None)
+    robots.load()
+    robots.heard('ev3dev-ssci-26', '10.0.0.2')
+    _write(path, [dict(_robots[0], name='renamed'), {'id': 3, 'name': 'new', 'btmac': None}], 1001)
+    assert robots.changed()
+    added, removed, changed = robots.load()
+    assert [rid['id'] for rid in added] == [3]
+    assert removed == [2]
+    assert [rid['name'] for rid in changed] == ['renamed']
+    assert robots.find(ip='10.0.0.2') is None
+    assert not robots.changed()
+
+
+def test_a_file_that_fails_to_load_is_retried_until_it_loads(path):
+    robots = fleet.Fleet(str(path), None)
+    robots.load()
+    path.write_text('{"robots": [', encoding='utf-8')
+    os.utime(path, (1001, 1001))
+    assert robots.changed()
+    with pytest.raises(ValueError):
+        robots.load()
+    assert robots.changed()
+    assert [rid['id'] for rid in robots.robots()] == [1, 2]  # left as it was
+    _write(path, _robots + [{'id': 3, 'name': 'new', 'btmac': None}], 1002)
+    assert [rid['id'] for rid in robots.load()[0]] == [3]
+    assert not robots.changed()
+
+
+def test_duplicates_are_refused(path):
+    _write(path, _robots + [{'id': 3, 'name': 'ev3dev-ssci-25', 'btmac': None}], 1001)
+    with pytest.raises(ValueError):
+        fleet.Fleet(str(path), None).load()
+
+
+def test_missing_file_is_an_empty_fleet(tmp_path):
+    robots = fleet.Fleet(str(tmp_path / 'absent.json'), None)
+    assert robots.load() == ([], [], [])
+    assert not robots.changed()
+
+
+def test_robot_with_a_new_hostname_is_found_by_address(path):
+    robots = fleet.Fleet(str(path), None)
+    robots.load()
+    assert robots.heard('ev3dev-ssci-25', '10.0.0.1') == 1
+    assert robots.heard('reflashed', '10.0.0.1') == 1
+    assert robots.heard('ev3dev-ssci-26', '10.0.0.1') == 2  # the address moved to another robot
+    assert robots.ip_of(1) is None
+    assert robots.heard('stranger', '10.0.0.9') is None
+
+
+def test_confirm_adds_a_pending_robot_to_the_file(path):
+    robots = fleet.Fleet(str(path), None)
+    robots.load()
+    assert robots.offer('new', '10.0.0.3', 32390, 5.0)
+    assert not robots.offer('new', '10.0.0.3', 32390, 6.0)  # already waiting
+    with pytest.raises(ValueError):
+        robots.confirm('new', 1)
+    with pytest.raises(ValueError):
+        robots.confirm('new', btmac='00:17:E9:B3:E3:57')
+    rid, ip, port = robots.confirm('new', btmac='aa:bb:cc:dd:ee:ff')
+    assert rid == {'id': 3, 'name': 'new', 'btmac': 'AA:BB:CC:DD:EE:FF'}
+    assert (ip, port) == ('10.0.0.3', 32390)
+    assert robots.find(ip='10.0.0.3') == 3 and robots.find(mac='AA:BB:CC:DD:EE:FF') == 3
+    assert not robots.changed()  # its own write is not an edit to reload
+    assert [entry['id'] for entry in json.loads(path.read_text(encoding='utf-8'))['robots']] == [1, 2, 3]
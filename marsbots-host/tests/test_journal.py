@@ -0,0 +1,83 @@
+import copy
+import json
+
+import journal
+
+
+def _records():
+    records = [
+        {'kind': 'config', 'config': [30, 10, 5, 20]},
+        {'kind': 'client', 'clientId': 'a'},
+        {'kind': 'client', 'clientId': 'b'},
+        {'kind': 'assign', 'clientId': 'a', 'robot': 1},
+        {'kind': 'game_start', 'game_id': 'g1', 'wall_base': 1000.0, 'time_scale': 1.0,
+         'config': [30, 10, 5, 20]},
+        {'kind': 'plan', 'plan_id': 7, 'robot': 1, 'plan': '[]', 'due': 1010.0, 'estimate': 0.0},
+        {'kind': 'plan', 'plan_id': 8, 'robot': 1, 'plan': None, 'due': 1020.0, 'estimate': 0.0},
+        {'kind': 'rescue', 'robot': 1},
+        {'kind': 'dispatch', 'plan_id': 7},
+        {'kind': 'client_evicted', 'clientId': 'b'},
+        {'kind': 'auto_assign', 'enabled': False},
+    ]
+    for seq, rec in enumerate(records, 1):
+        rec.update(seq=seq, t=1000.0 + seq)
+    return records
+
+
+def _replayed(records):
+    state = journal.empty_state()
+    for rec in records:
+        journal._apply(state, rec)
+    return state
+
+
+def test_replay_builds_the_game_state():
+    state = _replayed(_records())
+    assert state['config'] == [30, 10, 5, 20]
+    assert state['game']['game_id'] == 'g1'
+    assert state['assignments'] == {'a': 1}
+    assert state['known_clients'] == ['a']
+    assert state['rescues'] == [1]
+    assert list(state['plans']) == ['8']
+    assert state['next_plan_id'] == 9
+    assert state['auto_assign'] is False
+    assert state['seq'] == len(_records())
+
+
+def test_replaying_records_again_changes_nothing():
+    records = _records()
+    once = _replayed(records)
+    twice = copy.deepcopy(once)
+    for rec in records:
+        journal._apply(twice, rec)
+    assert twice == once
+    assert _replayed(records + records) == once
+
+
+def test_load_skips_records_a_snapshot_already_covers(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, '_journal_dir', str(tmp_path))
+    records = _records()
+    snapshot = _replayed(records[:6])
+    (tmp_path / 'snapshot.json').write_text(json.dumps(snapshot), encoding='utf-8')
+    # The journal still holds records the snapshot covers, as after a crash mid-compaction
+    lines = [json.dumps(rec) for rec in records[3:]]
+    (tmp_path / 'journal.jsonl').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    assert journal.load() == _replayed(records)
+
+
+def test_load_ignores_a_torn_last_line(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, '_journal_dir', str(tmp_path))
+    records = _records()
+    text = ''.join(json.dumps(rec) + '\n' for rec in records) + '{"kind": "plan", "plan_'
+    (tmp_path / 'journal.jsonl').write_text(text, encoding='utf-8')
+    assert journal.load() == _replayed(records)
+
+
+def test_game_end_clears_the_game():
+    records = _records()
+    records.append({'kind': 'game_end', 'seq': len(records) + 1, 't': 2000.0})
+    state = _replayed(records)
+    assert state['game'] is None
+    assert state['plans'] == {}
+    assert state['rescues'] == []
+    assert state['assignments'] == {'a': 1}
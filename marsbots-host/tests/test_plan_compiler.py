@@ -0,0 +1,36 @@
+import plan_compiler
+from plan_compiler import FORWARD, REVERSE, LEFT, RIGHT, GRAB, RELEASE, OP_DRIVE, OP_TURN, OP_GRAB, OP_RELEASE
+
+
+def test_adjacent_steps_on_one_axis_merge():
+    assert plan_compiler.merge_steps([(FORWARD, 1), (FORWARD, 1), (FORWARD, 0.5)]) == [(OP_DRIVE, 2.5)]
+    assert plan_compiler.merge_steps([(LEFT, 1), (RIGHT, 0.5)]) == [(OP_TURN, -0.5)]
+    assert plan_compiler.merge_steps([(FORWARD, 1), (REVERSE, 3)]) == [(OP_DRIVE, -2)]
+
+
+def test_cancelled_leg_brings_neighbours_together():
+    ops = plan_compiler.merge_steps([(FORWARD, 1), (LEFT, 1), (RIGHT, 1), (FORWARD, 1)])
+    assert ops == [(OP_DRIVE, 2)]
+
+
+def test_everything_cancels():
+    assert plan_compiler.merge_steps([(FORWARD, 1), (REVERSE, 1)]) == []
+    assert plan_compiler.merge_steps([(LEFT, 0.1), (RIGHT, 0.1)]) == []
+
+
+def test_zero_length_motions_are_dropped():
+    assert plan_compiler.merge_steps([(FORWARD, 0), (GRAB, 0), (RIGHT, 0)]) == [(OP_GRAB, 0.0)]
+
+
+def test_repeated_grabber_steps_collapse():
+    ops = plan_compiler.merge_steps([(GRAB, 0), (GRAB, 0), (REVERSE, 1), (RELEASE, 0), (RELEASE, 0)])
+    assert ops == [(OP_GRAB, 0.0), (OP_DRIVE, -1), (OP_RELEASE, 0.0)]
+
+
+def test_grabber_steps_keep_motions_apart():
+    ops = plan_compiler.merge_steps([(FORWARD, 1), (GRAB, 0), (FORWARD, 1)])
+    assert ops == [(OP_DRIVE, 1), (OP_GRAB, 0.0), (OP_DRIVE, 1)]
+
+
+def test_unknown_opcodes_are_skipped():
+    assert plan_compiler.merge_steps([(FORWARD, 1), (99, 5), (FORWARD, 1)]) == [(OP_DRIVE, 2)]
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import protocol
+
+UP, DOWN, LEFT, RIGHT = '↑', '↓', '←', '→'
+
+
+def test_plan_round_trip():
+    plan = json.dumps([[UP, 2], [LEFT, 0.5], ['Grab'], [DOWN, '1.5'], [RIGHT, 1], ['Release']])
+    plan_id, steps = protocol.decode_plan(protocol.encode_plan(plan, 42))
+    assert plan_id == 42
+    assert steps == [(protocol.OP_FORWARD, 2.0), (protocol.OP_LEFT, 0.5), (protocol.OP_GRAB, 0.0),
+                     (protocol.OP_REVERSE, 1.5), (protocol.OP_RIGHT, 1.0), (protocol.OP_RELEASE, 0.0)]
+
+
+def test_empty_plan_round_trip():
+    assert protocol.decode_plan(protocol.encode_plan('[]', 7)) == (7, [])
+
+
+@pytest.mark.parametrize('plan', [
+    None,
+    'not json',
+    '{"steps": []}',
+    json.dumps([['Sideways', 1]]),
+    json.dumps([[]]),
+    json.dumps([UP]),
+    json.dumps([[1, 1]]),
+    json.dumps([[UP, 'far']]),
+    json.dumps([[UP, None]]),
+    '[["↑", NaN]]',
+    '[["↑", Infinity]]',
+    json.dumps([[UP, 1e300]]),
+    json.dumps([[UP, 10 ** 400]]),
+])
+def test_encode_plan_rejects(plan):
+    with pytest.raises(ValueError):
+        protocol.encode_plan(plan, 1)
+
+
+def test_encode_plan_rejects_too_many_steps():
+    protocol.encode_plan(json.dumps([[UP, 1]] * protocol.max_plan_steps), 1)
+    with pytest.raises(ValueError):
+        protocol.encode_plan(json.dumps([[UP, 1]] * (protocol.max_plan_steps + 1)), 1)
+
+
+def test_decode_plan_rejects_bad_lengths():
+    payload = protocol.encode_plan(json.dumps([[UP, 1], [RIGHT, 1]]), 3)
+    with pytest.raises(ValueError):
+        protocol.decode_plan(payload[:3])
+    with pytest.raises(ValueError):
+        protocol.decode_plan(payload[:-1])
+    with pytest.raises(ValueError):
+        protocol.decode_plan(payload + b'\0')
@@ -0,0 +1,74 @@
+import clock
+import scheduler
+
+
+def _scheduler():
+    game_clock = clock.VirtualClock()
+    return game_clock, scheduler.Scheduler(game_clock)
+
+
+def test_run_until_dispatches_in_due_order_at_due_time():
+    game_clock, queue = _scheduler()
+    ran = []
+    for due, name in [(3.0, 'c'), (1.0, 'a'), (2.0, 'b')]:
+        queue.schedule(due, lambda name=name: ran.append((name, game_clock.now())))
+    queue.run_until(10.0)
+    assert ran == [('a', 1.0), ('b', 2.0), ('c', 3.0)]
+    assert game_clock.now() == 10.0
+    assert queue.pending() == 0
+
+
+def test_equal_due_times_run_in_the_order_scheduled():
+    _, queue = _scheduler()
+    ran = []
+    for name in 'abcde':
+        queue.schedule(5.0, ran.append, name)
+    queue.run_until(5.0)
+    assert ran == list('abcde')
+
+
+def test_entries_after_the_horizon_wait():
+    game_clock, queue = _scheduler()
+    ran = []
+    queue.schedule(1.0, ran.append, 1)
+    queue.schedule(4.0, ran.append, 4)
+    queue.run_until(2.0)
+    assert ran == [1]
+    assert game_clock.now() == 2.0
+    assert queue.next_due() == 4.0
+    queue.run_until(4.0)
+    assert ran == [1, 4]
+
+
+def test_entries_scheduled_by_a_dispatch_run_in_the_same_pass():
+    game_clock, queue = _scheduler()
+    ran = []
+
+    def chain(n):
+        ran.append((n, game_clock.now()))
+        if n < 3:
+            queue.schedule(game_clock.now() + 1.0, chain, n + 1)
+
+    queue.schedule(0.5, chain, 0)
+    queue.run_until(3.0)
+    assert ran == [(0, 0.5), (1, 1.5), (2, 2.5)]
+    assert queue.next_due() == 3.5
+
+
+def test_a_failing_entry_does_not_stop_the_rest():
+    _, queue = _scheduler()
+    ran = []
+    queue.schedule(1.0, lambda: 1 / 0)
+    queue.schedule(2.0, ran.append, 'after')
+    queue.run_until(3.0)
+    assert ran == ['after']
+    assert queue.get_lateness()[0] == 2
+
+
+def test_clear_drops_everything_pending():
+    _, queue = _scheduler()
+    ran = []
+    queue.schedule(1.0, ran.append, 1)
+    queue.clear()
+    queue.run_until(2.0)
+    assert ran == []